@@ -0,0 +1,97 @@
+import numpy as np
+import scipy.fft
+
+# Spectrum analyzer for the display
+# Audio is fed from the render thread into a preallocated ring; the GUI
+# thread runs a Hann-windowed STFT over it at display rate, with
+# exponential averaging and peak-hold. All buffers are reused.
+
+class SpectrumAnalyzer:
+    """
+    Inputs:
+        fs : sample rate
+        size : FFT size, a power of two
+        overlap : fraction of a frame shared with the next one
+        averaging : weight of the previous average, 0 disables averaging
+        peak_decay : factor applied to the held peaks every frame
+    """
+    def __init__(self, fs, size = 4096, overlap = 0.75, averaging = 0.7, peak_decay = 0.97):
+        if size & (size - 1):
+            raise ValueError('size must be a power of two')
+        self.fs = fs
+        self.size = size
+        self.hop = max(int(size * (1 - overlap)), 1)
+        self.averaging = averaging
+        self.peak_decay = peak_decay
+
+        n = np.arange(size)
+        self._window = (0.5 - 0.5 * np.cos(2 * np.pi * n / size)).astype('float32')
+        # amplitude of a full-scale sine maps to 1
+        self._scale = 2 / self._window.sum()
+        self.freqs = np.arange(size // 2 + 1) * (fs / size)
+
+        self._cap = 8 * size
+        self._ring = np.zeros(self._cap, dtype = 'float32')
+        self._w = 0
+        self._next = 0
+
+        self._frame = np.empty(size, dtype = 'float32')
+        # scipy.fft keeps single precision, numpy.fft would upcast
+        self._mag = np.empty(size // 2 + 1, dtype = 'float32')
+        self._avg = np.zeros(size // 2 + 1, dtype = 'float32')
+        self._peak = np.zeros(size // 2 + 1, dtype = 'float32')
+
+    def reset(self):
+        self._next = self._w
+        self._avg.fill(0)
+        self._peak.fill(0)
+
+    def feed(self, x):
+        """
+        Appends a mono signal or the channel mix of a (channels, frames)
+        array. Called from the producer thread only.
+        """
+        if x.ndim == 2:
+            x = x.mean(axis = 0)
+        x = x[-self._cap:]
+        n = len(x)
+        start = self._w % self._cap
+        first = min(n, self._cap - start)
+        self._ring[start:start+first] = x[:first]
+        self._ring[:n-first] = x[first:]
+        self._w += n
+
+    def update(self):
+        """
+        Analyzes all complete frames fed since the last call. Called from
+        the consumer (GUI) thread; returns True if the spectrum changed.
+        """
+        w = self._w
+        if w - self._next > self._cap - self.size:
+            # the display fell behind, skip to the most recent frames
+            self._next = w - self.size - (w - self.size - self._next) % self.hop
+
+        updated = False
+        while self._next + self.size <= w:
+            start = self._next % self._cap
+            first = min(self.size, self._cap - start)
+            self._frame[:first] = self._ring[start:start+first]
+            self._frame[first:] = self._ring[:self.size-first]
+            self._next += self.hop
+
+            np.multiply(self._frame, self._window, out = self._frame)
+            np.abs(scipy.fft.rfft(self._frame), out = self._mag)
+            self._mag *= self._scale * (1 - self.averaging)
+
+            self._avg *= self.averaging
+            self._avg += self._mag
+            self._peak *= self.peak_decay
+            np.maximum(self._peak, self._avg, out = self._peak)
+            updated = True
+        return updated
+
+    def spectrum(self):
+        """
+        Returns (freqs, averaged magnitude, held peak magnitude).
+        """
+        return self.freqs, self._avg, self._peak
@@ -0,0 +1,412 @@
+import argparse
+import time
+import warnings
+import numpy as np
+from numpy import asarray, array, append, zeros, ones, prod
+import scipy.signal as scsig
+from scipy.signal import lfilter
+from designtools import zpk2sos
+from filters import FilterType, Filter, FilterChain
+from utility import FreqGrid
+
+fs = 44100
+
+def _lfilterCascade(sos, zi_in, x):
+    # reference: one lfilter pass (and one output array) per section
+    y = x
+    zi_out = zi_in
+    for i in range(len(sos)):
+        y, zi_out[i] = lfilter(sos[i,:3], sos[i,3:], y, zi = zi_in[i])
+    return y, zi_out
+
+def defaultChain(precision = 'float64'):
+    """
+    The GUI default chain with every filter enabled: two 12th-order
+    brickwalls around three peak filters.
+    """
+    chain = FilterChain(fs = fs, precision = precision)
+    deffs = [100, 1000, 3000, 5000, 15000]
+    chain.addFilt(Filter(FilterType.HPBrickwall, deffs[0]))
+    chain.addFilt(Filter(FilterType.Peak, deffs[1], 6, 2))
+    chain.addFilt(Filter(FilterType.Peak, deffs[2], -3, 1))
+    chain.addFilt(Filter(FilterType.Peak, deffs[3], 4, 5))
+    chain.addFilt(Filter(FilterType.LPBrickwall, deffs[4]))
+    return chain
+
+def _throughput(fn, x, total):
+    # runs fn over `total` samples in len(x)-sized pieces, returns samples/s
+    n = 0
+    start = time.perf_counter()
+    while n < total:
+        fn(x[:min(len(x), total - n)])
+        n += len(x)
+    return total / (time.perf_counter() - start)
+
+def benchCascade(durations, piece = 60):
+    """
+    Compares the single-pass cascade engine with the per-section lfilter
+    loop. Long durations are streamed in `piece`-second buffers so that a
+    10 hour run does not need 10 hours of audio in memory.
+    """
+    chain = defaultChain()
+    sos = chain.sos()
+    x = np.random.randn(int(piece * fs)).astype('float32')
+
+    def loop(block):
+        zi = chain.getZi()[0]
+        y, zi = _lfilterCascade(sos, zi, block)
+        chain.updateZi(zi)
+
+    print('{:>10} {:>14} {:>14} {:>8}'.format('duration', 'loop [MS/s]', 'cascade [MS/s]', 'speedup'))
+    for d in durations:
+        total = int(d * fs)
+        chain.reset()
+        t_loop = _throughput(loop, x, total)
+        chain.reset()
+        t_casc = _throughput(chain.filter, x, total)
+        print('{:>9}s {:>14.2f} {:>14.2f} {:>7.2f}x'.format(d, t_loop / 1e6, t_casc / 1e6, t_casc / t_loop))
+
+# reference: the loop-based pairing and SOS assembly designtools replaced
+# (kept verbatim apart from integer section counts)
+def _legacyCplxpair(x, tol=1e-12) :
+    
+    if sum(x.shape) == 0 : return x
+    if not 'complex' in str(x.dtype) : return x
+    
+    # Reshape input to 1D array to simplify algorithm
+    x_shape = x.shape
+    x  = x.reshape(prod(array(list(x_shape))))
+    xout = array([])
+    tol = abs(tol)
+    
+    # Save original class of input
+    x_orig_class = x[0].__class__
+    
+    # New rule to sort
+    class __cplxpairsort__ (x_orig_class) :
+        def __gt__(self, a) :
+            return self.real > a.real
+        def __ge__(self, a) :
+            return self.real > a.real or self.__eq__(a)
+        def __lt__(self, a) :
+            return self.real < a.real
+        def __le__(self, a) :
+            return self.real < a.real or self.__eq__(a)
+        def __eq__(self, a) :
+            return abs(self.real-a.real) <= tol and abs(self.imag+a.imag) <= tol
+        def __ne__(self, a) :
+            return not self.__eq__(a)
+    
+    def post_sort(x_sort):
+        i = 0
+        pair = []
+        nopair = []
+        while True :
+            re, im = x_sort[i].real - x_sort[i+1].real,x_sort[i].imag + x_sort[i+1].imag
+            if abs(re) <= tol and abs(im) <= tol :
+                pair.append(x_sort[i])
+                pair.append(x_sort[i+1])
+                i += 1
+            else :
+                nopair.append(x_sort[i])
+            i += 1
+            if i >= len(x_sort)-1 : break
+        if len(pair) + len(nopair) != len(x_sort) : nopair.append(x_sort[-1])
+        return append(pair, nopair)
+    
+    # Change dtype of input to pair
+    x = x.astype(__cplxpairsort__)
+    
+    # Do it like multi-demension array with array sclicing.
+    for i in range((int)(x.shape[0]/x_shape[-1])):
+        x_sort = 1*x[i*x_shape[-1] : (i+1)*x_shape[-1]]
+        x_sort.sort()
+        x_sort = post_sort(x_sort)
+        xout = append(xout, 1*x_sort)
+    
+    # Return with original shape and original class
+    return xout.reshape(x_shape).astype(x_orig_class)
+
+def _legacyCplxreal(z, tol=1e-12) :
+    if z.shape[0] == 0 : zc=[];zr=[]
+    else :
+        zcp = _legacyCplxpair(z)
+        nz  = len(z)
+        nzrsec = 0
+        i = nz
+        while i and abs(zcp[i-1].imag) < tol:
+            zcp[i-1] = zcp[i-1].real
+            nzrsec = nzrsec+1
+            i=i-1
+        
+        nzsect2 = nz-nzrsec
+        if nzsect2%2 != 0 :
+            raise ValueError('cplxreal: Odd number of complex values!')
+    
+        nzsec = nzsect2/2
+        zc = zcp[1:nzsect2:2]
+        zr = zcp[nzsect2:nz]
+    return asarray(zc), asarray(zr)
+
+def _legacyZpk2sos(z,p,k) :
+    zc,zr = _legacyCplxreal(array(z))
+    pc,pr = _legacyCplxreal(array(p))
+    
+    nzc = len(zc)
+    npc = len(pc)
+    nzr = len(zr)
+    npr = len(pr)
+    
+    # Pair up real zeros:
+    if nzr :
+        if nzr%2 == 1 : zr = append(zr,0); nzr=nzr+1
+        nzrsec = nzr//2
+        zrms = -zr[:nzr-1:2]-zr[1:nzr:2]
+        zrp  =  zr[:nzr-1:2]*zr[1:nzr:2]
+    else :
+        nzrsec = 0
+    
+    # Pair up real poles:
+    if npr :
+        if npr%2 == 1 : pr = append(pr,0); npr=npr+1
+        nprsec = npr//2
+        prms = -pr[:npr-1:2]-pr[1:npr:2]
+        prp  =  pr[:npr-1:2]*pr[1:npr:2]
+    else :
+        nprsec = 0
+    
+    nsecs = max(nzc+nzrsec,npc+nprsec)
+    
+    # Convert complex zeros and poles to real 2nd-order section form:
+    zcm2r = -2*zc.real
+    zca2  = abs(zc)**2
+    pcm2r = -2*pc.real
+    pca2  = abs(pc)**2
+    
+    sos = zeros((nsecs,6))
+    
+    # all 2nd-order polynomials are monic
+    sos[:,0] = ones(nsecs)
+    sos[:,3] = ones(nsecs)
+    nzrl = nzc+nzrsec # index of last real zero section
+    nprl = npc+nprsec # index of last real pole section
+    
+    for i in range(int(nsecs)) :
+        if   i+1 <= nzc : # lay down a complex zero pair:
+            sos[i,1:3] = append(zcm2r[i], zca2[i])
+        elif i+1 <= nzrl: #lay down a pair of real zeros:
+            sos[i,1:3] = append(zrms[i-nzc], zrp[i-nzc])
+        if   i+1 <= npc : # lay down a complex pole pair:
+            sos[i,4:6] = append(pcm2r[i], pca2[i])
+        elif i+1 <= nprl: # lay down a pair of real poles:
+            sos[i,4:6] = append(prms[i-npc], prp[i-npc])
+    
+    if len(sos.shape) == 1 : sos = array([sos])
+
+    sos[0,0:3] *= k
+     
+    return sos, k
+
+def _perCall(fn, repeat):
+    start = time.perf_counter()
+    for i in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+def benchDesign(orders, repeat = 200):
+    """
+    Times zpk2sos against the loop-based implementation on elliptic and
+    Butterworth prototypes of every order, checking that both agree.
+    """
+    print('{:>6} {:>7} {:>11} {:>11} {:>8}'.format('design', 'order', 'loop [us]', 'vect [us]', 'speedup'))
+    for name, proto in [('ellip', lambda N: scsig.ellip(N, 0.01, 80, 0.1, output = 'zpk')),
+                        ('butter', lambda N: scsig.butter(N, 0.1, output = 'zpk'))]:
+        for N in orders:
+            z, p, k = proto(N)
+            with warnings.catch_warnings():
+                # the legacy code assigns complex values to the real SOS matrix
+                warnings.simplefilter('ignore')
+                if not np.array_equal(_legacyZpk2sos(z, p, k)[0], zpk2sos(z, p, k)[0]):
+                    raise AssertionError('zpk2sos mismatch for {} order {}'.format(name, N))
+                t_loop = _perCall(lambda: _legacyZpk2sos(z, p, k), repeat)
+            t_vect = _perCall(lambda: zpk2sos(z, p, k), repeat)
+            print('{:>6} {:>7} {:>11.1f} {:>11.1f} {:>7.2f}x'.format(name, N, t_loop * 1e6, t_vect * 1e6, t_loop / t_vect))
+
+def benchBands(bands, seconds = 10, rate = 48000):
+    """
+    CPU cost of chains of 1-31 peak filters spread over the audio band,
+    on stereo at 48 kHz: filtering throughput and the time to recompute
+    the response after one band changed.
+    """
+    x = np.random.randn(2, int(seconds * rate)).astype('float32') * 0.1
+    block = rate // 30
+    grid = FreqGrid(np.logspace(np.log10(2 * np.pi * 20 / rate), np.log10(np.pi), 512))
+
+    print('{:>6} {:>12} {:>14} {:>14} {:>13}'.format('bands', 'x realtime', 'CPU [%]', 'per band [%]',
+                                                     'response [us]'))
+    for n in bands:
+        chain = FilterChain(channels = 2, fs = rate)
+        for f in np.logspace(np.log10(31.5), np.log10(16000), n):
+            chain.addFilt(Filter(FilterType.Peak, f, 3, 4, fs = rate))
+        chain.magnitude(grid)
+
+        start = time.perf_counter()
+        for i in range(0, x.shape[1], block):
+            chain.filter(x[:, i:i+block])
+        cpu = (time.perf_counter() - start) / seconds
+
+        filt = chain._filters[n // 2]
+        def change():
+            chain.updateFilt(n // 2, Filter(filt._type, filt._fc, -filt._g, filt._Q, fs = rate))
+            chain.magnitude(grid)
+        t_resp = _perCall(change, 50)
+        print('{:>6} {:>12.0f} {:>14.3f} {:>14.4f} {:>13.1f}'.format(n, 1 / cpu, cpu * 100, cpu * 100 / n,
+                                                                    t_resp * 1e6))
+
+def benchPrecision(seconds = 10, rate = 48000):
+    """
+    float32 against float64 processing: throughput of the default chain
+    on stereo at 48 kHz, and the error of float32 output relative to
+    float64 for every filter type at low, mid and high frequencies, as
+    error-to-signal ratio in dB (16-bit PCM resolution is about -96 dB).
+    """
+    x64 = np.random.randn(2, int(seconds * rate)) * 0.1
+    x32 = x64.astype('float32')
+    block = rate // 30
+
+    print('{:>9} {:>12}'.format('precision', 'x realtime'))
+    for precision, x in [('float64', x64), ('float32', x32)]:
+        chain = defaultChain(precision)
+        chain.setSampleRate(rate)
+        chain.setChannels(2)
+        start = time.perf_counter()
+        for i in range(0, x.shape[1], block):
+            chain.filter(x[:, i:i+block])
+        print('{:>9} {:>12.0f}'.format(precision, seconds / (time.perf_counter() - start)))
+
+    print()
+    print('{:>12} {:>8} {:>12} {:>14}'.format('type', 'fc [Hz]', 'error [dB]', 'max abs error'))
+    names = {v: k for k, v in vars(FilterType).items() if not k.startswith('_')}
+    for ftype in sorted(names):
+        for fc in (30, 1000, 15000):
+            y = []
+            for precision, x in [('float64', x64[0]), ('float32', x32[0])]:
+                chain = FilterChain(fs = rate, precision = precision)
+                chain.addFilt(Filter(ftype, fc, 6, 2, fs = rate))
+                y.append(chain.filter(x))
+            err = y[1] - y[0]
+            ratio = np.sqrt(np.mean(err ** 2) / np.mean(y[0] ** 2))
+            print('{:>12} {:>8} {:>12.1f} {:>14.2e}'.format(names[ftype], fc, 20 * np.log10(ratio),
+                                                             np.abs(err).max()))
+
+def benchSegments(seconds = 120, workers = None):
+    """
+    Parallel segment rendering of one file against the serial render:
+    speed, and the error at the segment joins, which must stay below
+    the pre-roll tolerance (24-bit resolution).
+    """
+    import os
+    import tempfile
+    from render import renderFile, renderParallel
+    from wavio import WavWriter, WavReader
+
+    chain = defaultChain()
+    with tempfile.TemporaryDirectory() as tmp:
+        in_path = os.path.join(tmp, 'in.wav')
+        with WavWriter(in_path, 2, 4, fs, is_float = True) as ww:
+            for i in range(0, seconds, 10):
+                ww.writeframes((np.random.randn(10 * fs, 2) * 0.1).astype('<f4'))
+
+        paths = [os.path.join(tmp, 'serial.wav'), os.path.join(tmp, 'parallel.wav')]
+        start = time.perf_counter()
+        renderFile(chain, in_path, paths[0])
+        t_serial = time.perf_counter() - start
+        start = time.perf_counter()
+        renderParallel(chain, in_path, paths[1], workers)
+        t_parallel = time.perf_counter() - start
+
+        serial, parallel = [WavReader(p) for p in paths]
+        err = np.abs(parallel.samples().astype('float64') - serial.samples()).max()
+        ref = np.abs(serial.samples()).max()
+        serial.close()
+        parallel.close()
+
+    print('pre-roll: {} frames ({:.2f} s)'.format(chain.settleFrames(), chain.settleFrames() / fs))
+    print('{:>10} {:>12} {:>8}'.format('serial [s]', 'parallel [s]', 'speedup'))
+    print('{:>10.2f} {:>12.2f} {:>7.2f}x'.format(t_serial, t_parallel, t_serial / t_parallel))
+    print('max error: {:.1f} dB re peak'.format(20 * np.log10(err / ref + 1e-30)))
+    if err > ref * 2.0 ** -23:
+        raise AssertionError('segment joins differ from the serial render')
+
+def benchPresets(count = 1000):
+    """
+    Loading presets of 5 to 31 random bands with and without stored
+    coefficients, from a cold design cache.
+    """
+    import os
+    import tempfile
+    from filters import designCache
+    from preset import savePreset, loadPreset
+
+    rng = np.random.RandomState(0)
+    types = [FilterType.Peak, FilterType.LShelving, FilterType.HShelving, FilterType.LPButter,
+             FilterType.HPButter, FilterType.LPBrickwall, FilterType.HPBrickwall]
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = {True: [], False: []}
+        for i in range(count):
+            chain = FilterChain(fs = fs)
+            for j in range(rng.randint(5, 32)):
+                ftype = types[rng.randint(len(types))]
+                Q = rng.randint(1, 4) if ftype in (FilterType.LPButter, FilterType.HPButter) \
+                    else rng.uniform(0.3, 10)
+                chain.addFilt(Filter(ftype, rng.uniform(20, 20000), rng.uniform(-12, 12), Q, fs = fs))
+            for stored in (True, False):
+                path = os.path.join(tmp, '{}{}.json'.format(i, 'c' if stored else ''))
+                savePreset(chain, path, coefficients = stored)
+                paths[stored].append(path)
+
+        print('{:>12} {:>10} {:>14}'.format('coefficients', 'total [s]', 'per preset [ms]'))
+        for stored in (False, True):
+            designCache.clear()
+            start = time.perf_counter()
+            for path in paths[stored]:
+                loadPreset(path)
+            t = time.perf_counter() - start
+            print('{:>12} {:>10.2f} {:>14.2f}'.format('stored' if stored else 'designed', t, t / count * 1e3))
+            if stored and designCache.misses:
+                raise AssertionError('stored coefficients were not used')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'pyEQ benchmarks')
+    sub = parser.add_subparsers(dest = 'bench')
+    p = sub.add_parser('cascade', help = 'cascade engine vs per-section lfilter loop')
+    p.add_argument('--durations', type = float, nargs = '+', default = [60, 3600, 36000],
+                   help = 'buffer lengths in seconds (default: 1 min, 1 h, 10 h)')
+    p = sub.add_parser('design', help = 'vectorized zpk2sos vs loop-based pairing')
+    p.add_argument('--orders', type = int, nargs = '+', default = list(range(2, 33, 2)),
+                   help = 'filter orders (default: 2, 4, ... 32)')
+    p = sub.add_parser('bands', help = 'CPU per band at 48 kHz stereo')
+    p.add_argument('--bands', type = int, nargs = '+', default = [1, 5, 10, 15, 20, 31],
+                   help = 'numbers of bands (default: 1, 5, 10, 15, 20, 31)')
+    p = sub.add_parser('precision', help = 'float32 vs float64 speed and error per filter type')
+    p = sub.add_parser('segments', help = 'parallel segment rendering vs serial rendering')
+    p.add_argument('--seconds', type = int, default = 120, help = 'file length (default: 120)')
+    p.add_argument('-j', '--jobs', type = int, help = 'worker processes (default: one per CPU)')
+    p = sub.add_parser('presets', help = 'preset loading with and without stored coefficients')
+    p.add_argument('--count', type = int, default = 1000, help = 'number of presets (default: 1000)')
+    args = parser.parse_args()
+
+    if args.bench == 'cascade':
+        benchCascade(args.durations)
+    elif args.bench == 'design':
+        benchDesign(args.orders)
+    elif args.bench == 'bands':
+        benchBands(args.bands)
+    elif args.bench == 'precision':
+        benchPrecision()
+    elif args.bench == 'segments':
+        benchSegments(args.seconds, args.jobs)
+    elif args.bench == 'presets':
+        benchPresets(args.count)
+    else:
+        parser.print_help()
@@ -1,4 +1,5 @@
-from numpy import asarray, array, append, zeros, ones, prod
+from numpy import asarray, array, append, zeros, empty_like, arange, sort, \
+    flatnonzero, maximum
 
 def cplxpair(x, tol=1e-12) :
     """
@@ -18,61 +19,44 @@ def cplxpair(x, tol=1e-12) :
     """
     
     if sum(x.shape) == 0 : return x
-    if not 'complex' in str(x.dtype) : return x
-    
-    # Reshape input to 1D array to simplify algorithm
+    if x.dtype.kind != 'c' : return x
+
+    # Pair every row along the last dimension
     x_shape = x.shape
-    x  = x.reshape(prod(array(list(x_shape))))
-    xout = array([])
-    tol = abs(tol)
-    
-    # Save original class of input
-    x_orig_class = x[0].__class__
-    
-    # New rule to sort
-    class __cplxpairsort__ (x_orig_class) :
-        def __gt__(self, a) :
-            return self.real > a.real
-        def __ge__(self, a) :
-            return self.real > a.real or self.__eq__(a)
-        def __lt__(self, a) :
-            return self.real < a.real
-        def __le__(self, a) :
-            return self.real < a.real or self.__eq__(a)
-        def __eq__(self, a) :
-            return abs(self.real-a.real) <= tol and abs(self.imag+a.imag) <= tol
-        def __ne__(self, a) :
-            return not self.__eq__(a)
-    
-    def post_sort(x_sort):
-        i = 0
-        pair = []
-        nopair = []
-        while True :
-            re, im = x_sort[i].real - x_sort[i+1].real,x_sort[i].imag + x_sort[i+1].imag
-            if abs(re) <= tol and abs(im) <= tol :
-                pair.append(x_sort[i])
-                pair.append(x_sort[i+1])
-                i += 1
-            else :
-                nopair.append(x_sort[i])
-            i += 1
-            if i >= len(x_sort)-1 : break
-        if len(pair) + len(nopair) != len(x_sort) : nopair.append(x_sort[-1])
-        return append(pair, nopair)
-    
-    # Change dtype of input to pair
-    x = x.astype(__cplxpairsort__)
-    
-    # Do it like multi-demension array with array sclicing.
-    for i in range((int)(x.shape[0]/x_shape[-1])):
-        x_sort = 1*x[i*x_shape[-1] : (i+1)*x_shape[-1]]
-        x_sort.sort()
-        x_sort = post_sort(x_sort)
-        xout = append(xout, 1*x_sort)
-    
-    # Return with original shape and original class
-    return xout.reshape(x_shape).astype(x_orig_class)
+    x = x.reshape(-1, x_shape[-1])
+    xout = empty_like(x)
+    for i in range(x.shape[0]):
+        xout[i] = _pairsort(x[i], abs(tol))
+    return xout.reshape(x_shape)
+
+def _pairsort(x, tol):
+    # Sort by real part (then imaginary part), so that a conjugate pair ends
+    # up next to each other with the negative imaginary part first.
+    x_sort = sort(x)
+    n = len(x_sort)
+    if n < 2 : return x_sort
+
+    # m[i]: x_sort[i] and x_sort[i+1] form a conjugate pair
+    m = (abs(x_sort[:-1].real - x_sort[1:].real) <= tol) & \
+        (abs(x_sort[:-1].imag + x_sort[1:].imag) <= tol)
+
+    # Scanning left to right, a pair consumes both of its elements, so
+    # within a run of consecutive matches every other position starts a pair
+    i = arange(n - 1)
+    starts = m.copy()
+    starts[1:] &= ~m[:-1]
+    run_start = maximum.accumulate(i * starts)
+    first = (m & ((i - run_start) % 2 == 0)).nonzero()[0]
+
+    paired = zeros(n, dtype = bool)
+    paired[first] = True
+    paired[first + 1] = True
+    xout = empty_like(x_sort)
+    npair = 2 * len(first)
+    xout[0:npair:2] = x_sort[first]
+    xout[1:npair:2] = x_sort[first + 1]
+    xout[npair:] = x_sort[~paired]
+    return xout
 
 def cplxreal(z, tol=1e-12) :
     """
@@ -98,18 +82,15 @@ def cplxreal(z, tol=1e-12) :
     else :
         zcp = cplxpair(z)
         nz  = len(z)
-        nzrsec = 0
-        i = nz
-        while i and abs(zcp[i-1].imag) < tol:
-            zcp[i-1] = zcp[i-1].real
-            nzrsec = nzrsec+1
-            i=i-1
-        
+        # number of trailing real elements
+        nonreal = flatnonzero(abs(zcp.imag) >= tol)
+        nzrsec = nz - (nonreal[-1] + 1 if len(nonreal) else 0)
+        zcp[nz-nzrsec:] = zcp[nz-nzrsec:].real
+
         nzsect2 = nz-nzrsec
         if nzsect2%2 != 0 :
             raise ValueError('cplxreal: Odd number of complex values!')
-    
-        nzsec = nzsect2/2
+
         zc = zcp[1:nzsect2:2]
         zr = zcp[nzsect2:nz]
     return asarray(zc), asarray(zr)
@@ -154,51 +135,36 @@ def zpk2sos(z,p,k) :
     npr = len(pr)
     
     # Pair up real zeros:
-    if nzr :
-        if nzr%2 == 1 : zr = append(zr,0); nzr=nzr+1
-        nzrsec = nzr/2.0
-        zrms = -zr[:nzr-1:2]-zr[1:nzr:2]
-        zrp  =  zr[:nzr-1:2]*zr[1:nzr:2]
-    else :
-        nzrsec = 0
-    
+    if nzr%2 == 1 : zr = append(zr,0); nzr=nzr+1
+    nzrsec = nzr//2
+    zrms = -zr[:nzr-1:2]-zr[1:nzr:2]
+    zrp  =  zr[:nzr-1:2]*zr[1:nzr:2]
+
     # Pair up real poles:
-    if npr :
-        if npr%2 == 1 : pr = append(pr,0); npr=npr+1
-        nprsec = npr/2.0
-        prms = -pr[:npr-1:2]-pr[1:npr:2]
-        prp  =  pr[:npr-1:2]*pr[1:npr:2]
-    else :
-        nprsec = 0
-    
+    if npr%2 == 1 : pr = append(pr,0); npr=npr+1
+    nprsec = npr//2
+    prms = -pr[:npr-1:2]-pr[1:npr:2]
+    prp  =  pr[:npr-1:2]*pr[1:npr:2]
+
     nsecs = max(nzc+nzrsec,npc+nprsec)
-    
-    # Convert complex zeros and poles to real 2nd-order section form:
-    zcm2r = -2*zc.real
-    zca2  = abs(zc)**2
-    pcm2r = -2*pc.real
-    pca2  = abs(pc)**2
-    
+
     sos = zeros((nsecs,6))
-    
+
     # all 2nd-order polynomials are monic
-    sos[:,0] = ones(nsecs)
-    sos[:,3] = ones(nsecs)
-    nzrl = nzc+nzrsec # index of last real zero section
-    nprl = npc+nprsec # index of last real pole section
-    
-    for i in range(int(nsecs)) :
-        if   i+1 <= nzc : # lay down a complex zero pair:
-            sos[i,1:3] = append(zcm2r[i], zca2[i])
-        elif i+1 <= nzrl: #lay down a pair of real zeros:
-            sos[i,1:3] = append(zrms[i-nzc], zrp[i-nzc])
-        if   i+1 <= npc : # lay down a complex pole pair:
-            sos[i,4:6] = append(pcm2r[i], pca2[i])
-        elif i+1 <= nprl: # lay down a pair of real poles:
-            sos[i,4:6] = append(prms[i-npc], prp[i-npc])
-    
-    if len(sos.shape) == 1 : sos = array([sos])
+    sos[:,0] = 1
+    sos[:,3] = 1
+
+    # complex zero and pole pairs first, then pairs of real ones,
+    # converted to real 2nd-order section form:
+    sos[:nzc,1] = -2*zc.real
+    sos[:nzc,2] = abs(zc)**2
+    sos[nzc:nzc+nzrsec,1] = zrms.real
+    sos[nzc:nzc+nzrsec,2] = zrp.real
+    sos[:npc,4] = -2*pc.real
+    sos[:npc,5] = abs(pc)**2
+    sos[npc:npc+nprsec,4] = prms.real
+    sos[npc:npc+nprsec,5] = prp.real
 
     sos[0,0:3] *= k
-     
-    return sos, k
\ No newline at end of file
+
+    return sos, k
@@ -1,7 +1,11 @@
+import functools
+import threading
 import scipy.signal as scsig
 import numpy as np
+from collections import OrderedDict
 from designtools import zpk2sos
 from utility import sosfilter, sosfreqz
+from fir import linearPhaseKernel, PartitionedConvolver
 
 # Typical IIR _filters found in parametric equalizers nowadays
 # LPButter & HPButter are Butterworth _filters of order 2,4 or 8
@@ -17,113 +21,513 @@ class FilterType:
      HShelving = 5
      Peak = 6
 
-# Constructor designs a filter
+def _design(type, fc, gain, Q):
+    """
+    Returns the second-order sections of a filter, normalized to a0 == 1.
+    """
+    if type == FilterType.HPBrickwall:
+        z, p, k = scsig.ellip(12, 0.01, 80, fc, 'high', output='zpk')
+        sos = zpk2sos(z, p, k)[0]
+    elif type == FilterType.LPBrickwall:
+        z, p, k = scsig.ellip(12, 0.01, 80, fc, 'low', output='zpk')
+        sos = zpk2sos(z, p, k)[0]
+    elif type == FilterType.HPButter:
+        z, p, k = scsig.butter(2 ** Q, fc, btype = 'high', output='zpk')
+        sos = zpk2sos(z, p, k)[0]
+    elif type == FilterType.LPButter:
+        z, p, k = scsig.butter(2 ** Q, fc, output='zpk')
+        sos = zpk2sos(z, p, k)[0]
+    elif type == FilterType.LShelving or type == FilterType.HShelving:
+        A = 10 ** (gain / 20)
+        wc = np.pi * fc
+        wS = np.sin(wc)
+        wC = np.cos(wc)
+        alpha = wS / (2 * Q)
+        beta = A ** 0.5 / Q
+        c = 1
+        if type == FilterType.LShelving:
+            c = -1
+
+        b0 = A * (A + 1 + c * (A - 1) * wC + beta * wS)
+        b1 = - c * 2 * A * (A - 1 + c * (A + 1) * wC)
+        b2 = A * (A + 1 + c * (A - 1) * wC - beta * wS)
+        a0 = (A + 1 - c * (A - 1) * wC + beta * wS)
+        a1 = c * 2 * (A - 1 - c * (A + 1) * wC)
+        a2 = (A + 1 - c * (A - 1) * wC - beta * wS)
+        sos = np.array([[ b0, b1, b2, a0, a1, a2 ]])
+    elif type == FilterType.Peak:
+        wc = np.pi * fc
+        b, a = scsig.bilinear([1, 10 ** (gain / 20) * wc / Q, wc ** 2],
+            [1, wc / Q, wc ** 2])
+        sos = np.append(b, a).reshape(1, 6)
+
+    # normalize every section to a0 == 1 so that the whole cascade
+    # can be run by a single sosfilt call
+    return sos / sos[:, 3:4]
+
+# LRU cache of filter designs
+# Parameters are quantized before lookup (and design), so dragging a handle
+# back and forth over the same positions only designs every filter once.
+# Cached SOS matrices are read-only and shared between Filter instances.
+# The cache is shared by all threads (e.g. the jobs of service.py), so it
+# is only touched under its lock; designs are computed outside of it.
+# Only designs computed here are stored, so a bad coefficient file (see
+# preset.py) can never spread to other filters.
+class DesignCache:
+
+    fc_steps = 1200 # per octave
+    gain_step = 0.01 # dB
+    Q_step = 0.001
+
+    def __init__(self, size = 512):
+        self._size = size
+        self._designs = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def setSize(self, size):
+        with self._lock:
+            self._size = size
+            while len(self._designs) > size:
+                self._designs.popitem(last = False)
+
+    def clear(self):
+        with self._lock:
+            self._designs.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {'size': self._size, 'entries': len(self._designs),
+                    'hits': self.hits, 'misses': self.misses}
+
+    def _store(self, key, sos):
+        # with the lock held
+        if self._size > 0:
+            self._designs[key] = sos
+            self._designs.move_to_end(key)
+            if len(self._designs) > self._size:
+                self._designs.popitem(last = False)
+
+    def key(self, type, fc, gain, Q):
+        # parameters a filter type ignores are left out of the key
+        if type not in (FilterType.Peak, FilterType.LShelving, FilterType.HShelving):
+            gain = 0
+        if type in (FilterType.LPBrickwall, FilterType.HPBrickwall):
+            Q = 0
+        return (type, int(round(np.log2(fc) * self.fc_steps)),
+                int(round(gain / self.gain_step)), int(round(Q / self.Q_step)))
+
+    def design(self, type, fc, gain, Q):
+        key = self.key(type, fc, gain, Q)
+        with self._lock:
+            sos = self._designs.get(key)
+            if sos is not None:
+                self.hits += 1
+                self._designs.move_to_end(key)
+                return sos
+            self.misses += 1
+
+        t, fcq, gq, Qq = key
+        if type in (FilterType.LPButter, FilterType.HPButter):
+            Qq = Q
+        else:
+            Qq = Qq * self.Q_step
+        sos = _design(type, 2 ** (fcq / self.fc_steps), gq * self.gain_step, Qq)
+        sos.setflags(write = False)
+        with self._lock:
+            self._store(key, sos)
+        return sos
+
+designCache = DesignCache()
+
+# Changes whenever _design or the key quantization changes the designs, so
+# stored coefficients (see preset.py) of older versions are not used
+designVersion = 1
+
+def normalizedFc(fc, fs):
+    # keep the cutoff just below Nyquist, e.g. for a 20 kHz low pass
+    # at a 32 kHz sample rate
+    return min(fc * 2 / fs, 0.99)
+
+# Constructor designs a filter through the design cache, unless its
+# second-order sections (designed earlier for fs) are given
+# fc is given in Hz and normalized by the sample rate fs before design
 # elliptic & butter filters are designed as zero-poles and broken into
 # cascaded biquads (second-order-state) to avoid numerical errors
 class Filter:
-    def __init__(self, type, fc, gain = 0, Q = 1, enabled = True):
+    def __init__(self, type, fc, gain = 0, Q = 1, enabled = True, fs = 44100, sos = None):
         self._enabled = enabled
         self._type = type
         self._fc = fc
         self._g = gain
         self._Q = Q
+        self._fs = fs
 
-        if type == FilterType.HPBrickwall:
-            z, p, k = scsig.ellip(12, 0.01, 80, fc, 'high', output='zpk')
-            self._sos = zpk2sos(z, p, k)[0]
-        elif type == FilterType.LPBrickwall:
-            z, p, k = scsig.ellip(12, 0.01, 80, fc, 'low', output='zpk')
-            self._sos = zpk2sos(z, p, k)[0]
-        elif type == FilterType.HPButter:
-            z, p, k = scsig.butter(2 ** Q, fc, btype = 'high', output='zpk')
-            self._sos = zpk2sos(z, p, k)[0]
-        elif type == FilterType.LPButter:
-            z, p, k = scsig.butter(2 ** Q, fc, output='zpk')
-            self._sos = zpk2sos(z, p, k)[0]
-        elif type == FilterType.LShelving or type == FilterType.HShelving:
-            A = 10 ** (gain / 20)
-            wc = np.pi * fc
-            wS = np.sin(wc)
-            wC = np.cos(wc)
-            alpha = wS / (2 * Q)
-            beta = A ** 0.5 / Q
-            c = 1
-            if type == FilterType.LShelving:
-                c = -1
-
-            b0 = A * (A + 1 + c * (A - 1) * wC + beta * wS)
-            b1 = - c * 2 * A * (A - 1 + c * (A + 1) * wC)
-            b2 = A * (A + 1 + c * (A - 1) * wC - beta * wS)
-            a0 = (A + 1 - c * (A - 1) * wC + beta * wS)
-            a1 = c * 2 * (A - 1 - c * (A + 1) * wC)
-            a2 = (A + 1 - c * (A - 1) * wC - beta * wS)
-            self._sos = np.array([[ b0, b1, b2, a0, a1, a2 ]])
-        elif type == FilterType.Peak:
-            self.g = gain
-            wc = np.pi * fc
-            b, a = scsig.bilinear([1, 10 ** (gain / 20) * wc / Q, wc ** 2],
-                [1, wc / Q, wc ** 2])
-            self._sos = np.append(b, a).reshape(1, 6)
-
+        if sos is None:
+            self._sos = designCache.design(type, normalizedFc(fc, fs), gain, Q)
+        else:
+            self._sos = np.array(sos, dtype = 'float64')
+            self._sos.setflags(write = False)
         self._ord = self._sos.shape[0] * 2
+        self._mags = {}
         self.icReset()
 
-    def icReset(self):
-        self._zi = np.zeros(shape = (self._sos.shape[0], 2))
+    def redesign(self, fs):
+        """
+        Returns the same filter designed for sample rate fs.
+        """
+        return Filter(self._type, self._fc, self._g, self._Q, self._enabled, fs)
+
+    def magnitude(self, grid):
+        """
+        Magnitude response on a FreqGrid, cached per grid (e.g. the plot's
+        and the linear-phase kernel's).
+        """
+        # threads may ask for different grids at once: the result is only
+        # published complete, under its own grid
+        mag = self._mags.get(grid)
+        if mag is None:
+            mag = np.abs(sosfreqz(self._sos, grid)[1])
+            self._mags[grid] = mag
+        return mag
+
+    def icReset(self, channels = 1):
+        self._zi = np.zeros(shape = (channels, self._sos.shape[0], 2))
+
+def _locked(method):
+    # runs a FilterChain method under the chain's lock
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return wrapper
 
 # Class representing a cascade of filters
-# Currently there is 5 user adjustable filters
-# Filters can be enabled/disabled or changed at any time
+# Any number of filters (bands) can be added, inserted, removed,
+# enabled/disabled or changed at any time
+# The chain keeps one contiguous SOS matrix and one contiguous state array
+# for all enabled filters; each filter's _zi is a view into the latter.
+# Both are rebuilt only when the topology changes, never per audio block.
+# Every channel runs through the same coefficients with its own state,
+# so the state array has shape (channels, sections, 2).
+# All filters are designed for the chain's sample rate.
+# Changes made with ramp = True do not switch coefficients abruptly: the
+# previous cascade keeps running on a copy of its state and its output is
+# crossfaded into the new one over ramp_time seconds.
+# In linear-phase mode the chain applies an FIR kernel with the magnitude
+# response of its filters instead of the filters themselves; the kernel
+# is rebuilt on the next block after any change.
+# Coefficients, state and output use the chain's precision, float64 by
+# default or float32; input of another type is converted once on entry.
+# float32 saves little time (sosfilt is bound by its per-sample loop) and
+# loses accuracy with poles close to z = 1, e.g. 12th-order brickwalls at
+# low cutoffs; see benchmark.py precision.
+# Public methods hold the chain's (reentrant) lock, so that a GUI thread
+# can edit a chain while a playback thread filters through it: an edit
+# happens between two blocks, never during one.
 class FilterChain:
-    def __init__(self):
+    ramp_time = 0.02
+
+    def __init__(self, channels = 1, fs = 44100, precision = 'float64'):
         self._filters = []
+        self._dtype = np.dtype(precision)
+        self._channels = channels
+        self._fs = fs
+        self._sos = None
+        self._zi = None
+        self._fade = None
+        self._fir = None
+        self._fir_taps = 0
+        self._fir_block = 1024
+        self._kernel_dirty = False
+        self._lock = threading.RLock()
+
+    def __getstate__(self):
+        # the shared arrays are rebuilt on first use, so that unpickled
+        # filters get their state views back
+        with self._lock:
+            state = self.__dict__.copy()
+        state['_sos'] = None
+        state['_zi'] = None
+        state['_fade'] = None
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    def _invalidate(self):
+        self._sos = None
+        self._kernel_dirty = True
+
+    def _startRamp(self):
+        # a change during a running crossfade only retargets it, the fade
+        # still starts from what was heard before the first change
+        if self._fade is None and not self._fir_taps:
+            sos = self.sos()
+            frames = int(self.ramp_time * self._fs)
+            self._fade = [sos, self._zi.copy(), frames, frames]
 
+    def _rebuild(self):
+        enabled = [filt for filt in self._filters if filt._enabled is True]
+        n = sum(filt._sos.shape[0] for filt in enabled)
+        sos = np.empty(shape = (n, 6), dtype = self._dtype)
+        zi = np.empty(shape = (self._channels, n, 2), dtype = self._dtype)
+
+        k = 0
+        for filt in enabled:
+            m = filt._sos.shape[0]
+            sos[k:k+m] = filt._sos
+            zi[:, k:k+m] = filt._zi
+            filt._zi = zi[:, k:k+m]
+            k += m
+        self._sos = sos
+        self._zi = zi
+
+    @_locked
     def sos(self, i = -1):
         """
         Returns second-order-section matrix of this chain or one filt.
         """
         if i != -1:
             return self._filters[i]._sos
-        
-        sos = np.ones(shape = (1,6))
 
+        if self._sos is None:
+            self._rebuild()
+        return self._sos
+
+    def channels(self):
+        return self._channels
+
+    @_locked
+    def setChannels(self, channels):
+        """
+        Changes the number of channels filtered; resets the state.
+        """
+        if channels != self._channels:
+            self._channels = channels
+            self._fade = None
+            for filt in self._filters:
+                filt.icReset(channels)
+            self._invalidate()
+            self._fir = None
+
+    @_locked
+    def magnitude(self, grid):
+        """
+        Magnitude response of the enabled filters on a FreqGrid. Only
+        filters not yet evaluated on grid are recomputed.
+        """
+        H = np.ones(len(grid.w))
         for filt in self._filters:
             if filt._enabled is True:
-                sos = np.append(sos, filt._sos, axis = 0)
-        return sos
+                H *= filt.magnitude(grid)
+        return H
 
-    def setFiltEnabled(self, i, enable):
+    def fs(self):
+        return self._fs
+
+    def precision(self):
+        return self._dtype
+
+    @_locked
+    def setPrecision(self, precision):
+        """
+        Sets the floating point type used for processing, 'float32' or
+        'float64'; the state is kept (converted).
+        """
+        precision = np.dtype(precision)
+        if precision != self._dtype:
+            self._dtype = precision
+            self._fade = None
+            self._fir = None
+            self._invalidate()
+
+    @_locked
+    def setSampleRate(self, fs):
+        """
+        Redesigns every filter for sample rate fs; resets the state.
+        """
+        if fs != self._fs:
+            self._fs = fs
+            self._fade = None
+            self._filters = [filt.redesign(fs) for filt in self._filters]
+            for filt in self._filters:
+                filt.icReset(self._channels)
+            self._invalidate()
+
+    def count(self):
+        return len(self._filters)
+
+    def addFilt(self, filt, ramp = False):
+        self.insertFilt(len(self._filters), filt, ramp)
+
+    @_locked
+    def insertFilt(self, i, filt, ramp = False):
+        """
+        Inserts a filter before index i, with a crossfade if ramp.
+        """
+        if filt._fs != self._fs:
+            filt = filt.redesign(self._fs)
+        if ramp:
+            self._startRamp()
+        filt.icReset(self._channels)
+        self._filters.insert(i, filt)
+        self._invalidate()
+
+    @_locked
+    def removeFilt(self, i, ramp = False):
+        """
+        Removes filter i and returns it, with a crossfade if ramp.
+        """
+        if ramp:
+            self._startRamp()
+        filt = self._filters.pop(i)
+        self._invalidate()
+        return filt
+
+    @_locked
+    def setFiltEnabled(self, i, enable, ramp = False):
+        if ramp:
+            self._startRamp()
         filt = self._filters[i]
         filt._enabled = enable
         if enable is True:
-            filt._zi = np.zeros(shape = (filt._sos.shape[0], 2))
+            filt.icReset(self._channels)
+        self._invalidate()
 
-    def updateFilt(self, i, new):
+    @_locked
+    def updateFilt(self, i, new, ramp = False):
+        """
+        Replaces filter i. With ramp, the output is crossfaded from the
+        previous coefficients to the new ones, see ramp_time.
+        """
+        if new._fs != self._fs:
+            new = new.redesign(self._fs)
+        if ramp:
+            self._startRamp()
         old = self._filters[i]
         self._filters[i] = new
         if old._type == new._type and old._ord == new._ord:
             self._filters[i]._zi = old._zi
+        else:
+            new.icReset(self._channels)
+        self._invalidate()
 
+    @_locked
     def getZi(self):
-        zi = [[0, 0]]
-        for filt in self._filters:
-            if filt._enabled is True:
-                zi.extend(filt._zi)
-        return zi
+        """
+        Returns the state array of all enabled sections,
+        shape (channels, sections, 2).
+        """
+        self.sos()
+        return self._zi
 
+    @_locked
     def updateZi(self, zi):
-        n = 1
-        for filt in self._filters:
-            if filt._enabled is True:
-                m = filt._sos.shape[0]
-                filt._zi = zi[n:n+m]
-                n += m
+        self.sos()
+        self._zi[...] = zi
+
+    @_locked
+    def setLinearPhase(self, taps, block = 1024):
+        """
+        Switches to linear-phase FIR filtering with a kernel of taps
+        coefficients convolved in partitions of block frames, or back to
+        the IIR filters if taps is 0. Resets the state.
+        """
+        self._fir_taps = taps | 1 if taps else 0
+        self._fir_block = block
+        self._fir = None
+        self._fade = None
+        self.reset()
+
+    def linearPhase(self):
+        return self._fir_taps
 
+    def latency(self):
+        """
+        Delay of the output in frames: the kernel delay plus one block in
+        linear-phase mode, 0 for the IIR filters.
+        """
+        if not self._fir_taps:
+            return 0
+        return self._fir_taps // 2 + self._fir_block
+
+    @_locked
+    def settleFrames(self, tol = 2.0 ** -24):
+        """
+        Number of frames after which the response to earlier input has
+        decayed below tol (relative), estimated from the largest pole
+        radius of the cascade; exact in linear-phase mode. None if the
+        cascade is not stable.
+        """
+        if self._fir_taps:
+            return self._fir_taps + self._fir_block
+        a = self.sos()[:, 3:].astype('float64')
+        if len(a) == 0:
+            return 0
+        disc = np.sqrt(a[:, 1] ** 2 - 4 * a[:, 2] + 0j)
+        r = np.abs(np.concatenate((-a[:, 1] + disc, -a[:, 1] - disc)) / 2).max()
+        if r >= 1:
+            return None
+        if r == 0:
+            return 2
+        # r ** n bounds a single pole; doubled for the slower decay of
+        # clustered poles (n ** k * r ** n)
+        return 2 * int(np.ceil(np.log(tol) / np.log(r)))
+
+    def _firFilter(self, x):
+        if self._fir is None:
+            self._fir = PartitionedConvolver(linearPhaseKernel(self, self._fir_taps), self._fir_block,
+                                             self._channels, self._dtype)
+            self._kernel_dirty = False
+        elif self._kernel_dirty:
+            self._fir.setKernel(linearPhaseKernel(self, self._fir_taps))
+            self._kernel_dirty = False
+        if x.ndim == 1:
+            return self._fir.process(x[np.newaxis])[0]
+        return self._fir.process(x)
+
+    @_locked
     def reset(self):
+        self._fade = None
+        if self._fir is not None:
+            self._fir.reset()
         for filt in self._filters:
-            filt.icReset()
-                    
+            filt._zi.fill(0)
+
+    @_locked
     def filter(self, x):
-        y, zi = sosfilter(self.sos(), self.getZi(), x)
-        self.updateZi(zi)
-        return y
\ No newline at end of file
+        """
+        Filters a mono signal or a (channels, frames) array.
+        """
+        x = np.asarray(x, dtype = self._dtype)
+        self.setChannels(1 if x.ndim == 1 else x.shape[0])
+        if self._fir_taps:
+            return self._firFilter(x)
+        if x.ndim == 1:
+            y, zi = sosfilter(self.sos(), self._zi[0], x)
+        else:
+            y, zi = sosfilter(self.sos(), self._zi, x)
+        self._zi[...] = zi
+        if self._fade is not None:
+            y = self._crossfade(x, y)
+        return y
+
+    def _crossfade(self, x, y):
+        sos, zi, left, frames = self._fade
+        n = min(left, x.shape[-1])
+        # the old cascade only runs for the frames still fading
+        y_old, zi[...] = sosfilter(sos, zi if x.ndim > 1 else zi[0], x[..., :n])
+        w = ((np.arange(frames - left, frames - left + n) + 1) / (frames + 1)).astype(y.dtype)
+        y[..., :n] -= y_old
+        y[..., :n] *= w
+        y[..., :n] += y_old
+        self._fade[2] = left - n
+        if left == n:
+            self._fade = None
+        return y
@@ -0,0 +1,105 @@
+import numpy as np
+import scipy.fft
+from utility import FreqGrid
+
+# Linear-phase filtering
+# The magnitude response of a FilterChain is sampled on a uniform grid and
+# turned into a symmetric (zero-phase, then delayed) FIR kernel, which is
+# applied with uniformly partitioned overlap-save convolution: the kernel
+# is split into block-sized partitions whose spectra are kept, and each
+# input block costs one FFT, one multiply-add per partition and one
+# inverse FFT, so CPU and latency depend on the block size rather than
+# on the kernel length.
+
+_grids = {}
+
+def linearPhaseKernel(chain, taps = 8191):
+    """
+    Returns a linear-phase FIR kernel of odd length taps with the
+    magnitude response of the enabled filters of chain; its delay is
+    taps // 2 samples.
+    """
+    taps |= 1
+    n = taps + 1
+    grid = _grids.get(n)
+    if grid is None:
+        # kept, so that the per-filter magnitude caches stay valid
+        grid = FreqGrid(np.linspace(0, np.pi, n // 2 + 1))
+        _grids[n] = grid
+    h = np.fft.irfft(chain.magnitude(grid), n)
+    # centre the zero-phase response and taper the truncation
+    h = np.concatenate((h[n - taps // 2:], h[:taps // 2 + 1]))
+    return h * np.kaiser(taps, 10.0)
+
+class PartitionedConvolver:
+    """
+    Streaming convolution of (channels, frames) signals with a kernel,
+    by uniformly partitioned overlap-save. Output is delayed by block
+    samples relative to plain convolution; any number of frames can be
+    passed per call.
+
+    Inputs:
+        kernel : FIR coefficients
+        block : partition size, the extra latency; a power of two
+        channels : number of channels processed
+        precision : floating point type of the processing
+    """
+    def __init__(self, kernel, block = 1024, channels = 1, precision = 'float64'):
+        self.block = block
+        self.channels = channels
+        self._dtype = np.dtype(precision)
+        self._parts = 0
+        self.setKernel(kernel)
+
+    def setKernel(self, kernel):
+        """
+        Replaces the kernel. The input history is kept unless the number
+        of partitions changes.
+        """
+        B = self.block
+        parts = -(-len(kernel) // B)
+        padded = np.zeros(parts * B, dtype = self._dtype)
+        padded[:len(kernel)] = kernel
+        # each partition is zero-padded to 2 * block by the FFT
+        self._H = scipy.fft.rfft(padded.reshape(parts, B), 2 * B)
+        if parts != self._parts:
+            self._parts = parts
+            self.reset()
+
+    def reset(self):
+        B = self.block
+        self._fdl = np.zeros((self._parts, self.channels, B + 1), dtype = self._H.dtype)
+        self._slot = 0
+        self._buf = np.zeros((self.channels, 2 * B), dtype = self._dtype)
+        self._y = np.zeros((self.channels, B), dtype = self._dtype)
+        self._fill = 0
+
+    def _convolveBlock(self):
+        # the delay line holds input spectra newest first from _slot down,
+        # wrapping around, so that partition p meets the input of p blocks ago
+        B = self.block
+        s = self._slot
+        self._fdl[s] = scipy.fft.rfft(self._buf)
+        Y = np.einsum('pcf,pf->cf', self._fdl[s::-1], self._H[:s+1])
+        if s + 1 < self._parts:
+            Y += np.einsum('pcf,pf->cf', self._fdl[:s:-1], self._H[s+1:])
+        self._y[...] = scipy.fft.irfft(Y, 2 * B)[:, B:]
+        self._buf[:, :B] = self._buf[:, B:]
+        self._slot = (s + 1) % self._parts
+
+    def process(self, x):
+        B = self.block
+        n = x.shape[-1]
+        y = np.empty((self.channels, n), dtype = self._dtype)
+        done = 0
+        while done < n:
+            k = min(B - self._fill, n - done)
+            f = self._fill
+            self._buf[:, B+f:B+f+k] = x[:, done:done+k]
+            y[:, done:done+k] = self._y[:, f:f+k]
+            self._fill = f + k
+            done += k
+            if self._fill == B:
+                self._convolveBlock()
+                self._fill = 0
+        return y
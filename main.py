@@ -1,12 +1,19 @@
 from PySide.QtCore import*
 from PySide.QtGui import*
 import pyaudio
-import wave
+import copy
 import time
 import numpy as np
 from collections import OrderedDict
 from filters import FilterType, Filter, FilterChain
-from utility import byteToPCM, floatToPCM, pcmToFloat, sosfreqz, toPixelCords, fromPixelCords
+from render import renderFile
+from preset import readPreset, chainFromPreset, savePreset
+from profiling import profiler
+from playback import Player
+from wavio import WavReader
+from analyzer import SpectrumAnalyzer
+from utility import FreqGrid, LogBinning
+from plotutil import toPixelCords, fromPixelCords, toPixelArrays, toPolygon
 
 filterTypes = OrderedDict({
     FilterType.LPButter: 'Low Pass (Flat)', 
@@ -18,7 +25,7 @@ filterTypes = OrderedDict({
     FilterType.Peak: 'Peak'})
 
 
-fs = 44100
+fs = 44100 # until a file is loaded
 eps = 0.0000001
 
 class Params:
@@ -99,13 +106,34 @@ class PlotCurve(object):
         self.brush = brush
         self.xdata = []
         self.ydata = []
+        self._shape = None
+        self._key = None
 
     def setData(self, x, y):
-        if self.is_path:
-            self._path = QPainterPath()
-
         self.xdata = x
         self.ydata = y
+        self._shape = None
+
+    def shape(self, width, height, xaxis, yaxis):
+        """
+        Returns the curve as a QPolygonF (or a QPainterPath starting at the
+        origin if is_path), rebuilt only when the data or the size changed.
+        """
+        key = (width, height, xaxis, yaxis)
+        if self._shape is None or self._key != key:
+            x = self.xdata
+            y = self.ydata
+            if self.is_path:
+                x = np.append(0, x)
+                y = np.append(0, y)
+            poly = toPolygon(*toPixelArrays(width, height, x, xaxis, y, yaxis))
+            if self.is_path:
+                self._shape = QPainterPath()
+                self._shape.addPolygon(poly)
+            else:
+                self._shape = poly
+            self._key = key
+        return self._shape
 
 class PlotWin(QFrame):
     def __init__(self, *args):
@@ -114,6 +142,7 @@ class PlotWin(QFrame):
         self.setAutoFillBackground(True)
         self.show()
 
+        self.fs = fs
         self.xaxis = Axis('bottom', 50, fs / 2, log = True)
         self.laxis = Axis('left', -100, 0)
         self.raxis = Axis('right', -10, 10)
@@ -122,21 +151,46 @@ class PlotWin(QFrame):
         pen1 = QPen(Qt.gray)
         pen1.setWidth(1.5)
         self.speccurv = PlotCurve(pen1)
+        self.peakcurv = PlotCurve(QPen(QColor(200, 200, 200, 90)))
         pen2 = QPen()
         pen2.setWidth(2)
         pen2.setColor(Qt.red)
         self.TFcurv = PlotCurve(pen2)
-        w0 = self.xaxis.min * 2 * np.pi / fs
-        self.wor = np.logspace(np.log10(w0), np.log10(np.pi), 512)
+        self.setGrid()
         self.refresh_rate = 30
 
+        self.tick_pen = QPen(QColor(200, 200, 200))
+        self.grid_major_pen = QPen(QColor(255, 255, 255, 80))
+        self.grid_major_pen.setStyle(Qt.DashLine)
+        self.grid_minor_pen = QPen(QColor(255, 255, 255, 40))
+        self.grid_minor_pen.setStyle(Qt.DashLine)
+        self.ticks = {}
+        self.focus_curve = (None, None)
+        self.binning = None
+
         self.chain = None
-        self.handles = [QPoint()] * 5
+        self.handles = []
         self.dragged = False
         self.focused = -1
 
+    def setGrid(self):
+        w0 = self.xaxis.min * 2 * np.pi / self.fs
+        self.wor = np.logspace(np.log10(w0), np.log10(np.pi), 512)
+        self.grid = FreqGrid(self.wor)
+
+    def setSampleRate(self, rate):
+        self.fs = rate
+        self.xaxis.max = rate / 2
+        self.setGrid()
+        self.ticks = {}
+        self.focus_curve = (None, None)
+        self.binning = None
+        self.speccurv.setData([], [])
+        self.peakcurv.setData([], [])
+
     def resizeEvent(self, e):
         QFrame.resizeEvent(self, e)
+        self.ticks = {}
         gradient = QLinearGradient(QPointF(self.width() / 2, 0), QPointF(self.width() / 2, self.height()))
         gradient.setColorAt(0, QColor(100, 102, 127))
         gradient.setColorAt(1, QColor(0, 0, 0))
@@ -164,7 +218,7 @@ class PlotWin(QFrame):
             old = self.parent().chain._filters[i]
             if old._type not in (FilterType.Peak, FilterType.LShelving, FilterType.HShelving):
                 g = 0
-            self.parent().chain.updateFilt(i,Filter(old._type, fc * 2 / fs, g, Q = old._Q))
+            self.parent().chain.updateFilt(i,Filter(old._type, fc, g, Q = old._Q, fs = self.fs), ramp = True)
             self.updateHandles()
             self.parent().updateChainTF()
             self.update()
@@ -175,6 +229,7 @@ class PlotWin(QFrame):
         QApplication.restoreOverrideCursor()
 
     def paintEvent(self, e):
+        start = time.perf_counter()
         QFrame.paintEvent(self, e)
         self.rect = QRectF(0, 0, self.width(), self.height() - 10)
 
@@ -186,17 +241,21 @@ class PlotWin(QFrame):
         self.drawTicks(qp, self.raxis)      
 
         #paint filter response
-        filt = self.parent().chain._filters[self.focused]
-        if filt._enabled:
-            w, H = sosfreqz(filt._sos, self.wor)
-            pen = QPen((QColor(170, 0, 0)))
-            pen.setWidth(1.5)
-            if filt._type == FilterType.Peak:
-                c = PlotCurve(pen, QBrush(QColor(255, 255, 255, 50)), is_path = True)
-            else:
-                c = PlotCurve(pen, is_path = True)
+        filters = self.parent().chain._filters
+        filt = filters[self.focused] if filters else None
+        if filt is not None and filt._enabled:
+            shown, c = self.focus_curve
+            if shown is not filt:
+                H = filt.magnitude(self.grid)
+                pen = QPen((QColor(170, 0, 0)))
+                pen.setWidth(1.5)
+                if filt._type == FilterType.Peak:
+                    c = PlotCurve(pen, QBrush(QColor(255, 255, 255, 50)), is_path = True)
+                else:
+                    c = PlotCurve(pen, is_path = True)
 
-            c.setData(w * 0.5 / np.pi * fs, 20 * np.log10(np.abs(H) + eps))
+                c.setData(self.wor * 0.5 / np.pi * self.fs, 20 * np.log10(H + eps))
+                self.focus_curve = (filt, c)
             self.plot(qp, c, self.raxis)
 
         #paint chain response
@@ -206,31 +265,33 @@ class PlotWin(QFrame):
         self.drawHandles(qp)  
         
         #paint the spectrum
+        self.plot(qp, self.peakcurv, self.laxis)
         self.plot(qp, self.speccurv, self.laxis)    
 
+        #paint the profiling overlay
+        if profiler.enabled:
+            qp.setPen(self.tick_pen)
+            qp.setFont(QFont('Monospace', 8))
+            for i, line in enumerate(profiler.lines()):
+                qp.drawText(QPointF(40, 20 + 12 * i), line)
+        profiler.record('paint', time.perf_counter() - start)
+
     def plot(self, qp, curve, yaxis):
-        w = self.width()
-        h = self.height()
         qp.setPen(curve.pen)
         qp.setBrush(curve.brush)
-        
+
+        shape = curve.shape(self.width(), self.height(), self.xaxis, yaxis)
         if curve.is_path:
-            if curve._path.elementCount() == 0:                
-                curve._path.moveTo(toPixelCords(w, h, 0, self.xaxis, 0, yaxis))
-                for x, y in zip(curve.xdata, curve.ydata):
-                    curve._path.lineTo(toPixelCords(w, h, x, self.xaxis, y, yaxis))
-            qp.drawPath(curve._path)
+            qp.drawPath(shape)
         else:
-            poly = QPolygon()
-            for x, y in zip(curve.xdata, curve.ydata):
-                poly << toPixelCords(w, h, x, self.xaxis, y, yaxis)
-            qp.drawPolyline(poly)
+            qp.drawPolyline(shape)
 
     def updateHandles(self):
 
+        self.handles = [None] * len(self.parent().chain._filters)
         for i, filter in enumerate(self.parent().chain._filters):
             if filter._enabled is True:
-                fc = filter._fc * fs * 0.5
+                fc = filter._fc
                 if filter._type not in (FilterType.Peak, FilterType.LShelving, FilterType.HShelving):
                     y = 0
                 else:
@@ -242,13 +303,17 @@ class PlotWin(QFrame):
             else:
                 self.handles[i] = None
 
-    def updateSpectrum(self, dft):
+    def updateSpectrum(self, freqs, mag, peak = None):
 
-        if dft.size > 0:
-                    N = dft.size
-                    self.speccurv.setData([fs / 2 / N * i for i in range(0,N)],
-                                                   20 * np.log10(np.abs(dft / N) + eps))
-                    self.update()
+        b = self.binning
+        if b is None or b.nbins != len(freqs) or b.bands != self.width():
+            # one band per pixel column
+            b = LogBinning(freqs, self.xaxis.min, self.xaxis.max, max(self.width(), 1))
+            self.binning = b
+        self.speccurv.setData(b.freqs, 20 * np.log10(b.reduce(mag) + eps))
+        if peak is not None:
+            self.peakcurv.setData(b.freqs, 20 * np.log10(b.reduce(peak) + eps))
+        self.update()
 
     def drawHandles(self, qp):
                          
@@ -268,72 +333,80 @@ class PlotWin(QFrame):
                 qp.setBrush(QBrush(QColor(0,0,0,alpha)))
                 qp.drawEllipse(h, 4 / m, 4 / m)
         
-    def drawTicks(self, qp, axis):
-        tick_pen = QPen(QColor(200, 200, 200))
-        qp.setPen(tick_pen)
-        grid_major_pen = QPen(QColor(255, 255, 255, 80))
-        grid_major_pen.setStyle(Qt.DashLine)
-        grid_minor_pen = QPen(QColor(255, 255, 255, 40))
-        grid_minor_pen.setStyle(Qt.DashLine)
-        majors = []
-        minors = []
+    def tickGeometry(self, axis):
+        """
+        Returns (tick lines, major grid lines, minor grid lines, labels) of
+        an axis, computed once per widget size.
+        """
+        if axis.type in self.ticks:
+            return self.ticks[axis.type]
+
+        ticks = []
+        major_grid = []
+        minor_grid = []
+        labels = []
         ticklen = 10
         w = self.width()
         h = self.height()
-        xaxis = self.xaxis
         bgap = self.height() - self.rect.height()
 
-        
         if axis.type == 'bottom':
             majors = [100, 1000, 10000]
+            minors = []
             for i in range(1,5):
                 minors.extend([j * 10 ** i for j in range(2,10)])
 
-            qp.drawLine(self.rect.bottomLeft(), self.rect.bottomRight())          
-            for tick in majors:
-
-                qp.setPen(tick_pen)
-                qp.drawLine(toPixelCords(w, h, tick, xaxis), h - bgap, toPixelCords(w, h, tick, xaxis), h - bgap - ticklen)
-                qp.drawText(toPixelCords(w, h, tick, xaxis) - bgap, h, str(tick))
-
-                qp.setPen(grid_major_pen)
-                qp.drawLine(toPixelCords(w, h, tick, xaxis), h - bgap - ticklen, toPixelCords(w, h, tick, xaxis), 0)
+            ticks.append(QLineF(self.rect.bottomLeft(), self.rect.bottomRight()))
+            for tick, xp in zip(majors, toPixelArrays(w, h, majors, self.xaxis).tolist()):
+                ticks.append(QLineF(xp, h - bgap, xp, h - bgap - ticklen))
+                labels.append((QPointF(xp - bgap, h), str(tick)))
+                major_grid.append(QLineF(xp, h - bgap - ticklen, xp, 0))
 
-            for tick in minors:
-                qp.setPen(tick_pen)
-                qp.drawLine(toPixelCords(w, h, tick, xaxis), h - bgap, toPixelCords(w, h, tick, xaxis), h - bgap - ticklen * 0.5)
-              
-                qp.setPen(grid_minor_pen)
-                qp.drawLine(toPixelCords(w, h, tick, xaxis), h - bgap - ticklen * 0.5, toPixelCords(w, h, tick, xaxis), 0)
+            for xp in toPixelArrays(w, h, minors, self.xaxis).tolist():
+                ticks.append(QLineF(xp, h - bgap, xp, h - bgap - ticklen * 0.5))
+                minor_grid.append(QLineF(xp, h - bgap - ticklen * 0.5, xp, 0))
 
         elif axis.type == 'left':
-
+            majors = []
             i = 1
             while -i * 10 > axis.min:
                 majors.append(-i * 10)
                 i = i + 1
-            qp.drawLine(0, 0, 0, self.height() - bgap)
-            qp.drawText(ticklen, 15, '[dB]')
-            for tick in majors:
-                
-                qp.setPen(tick_pen)
-                yp = toPixelCords(w, h, 0, xaxis, tick, self.laxis).y()
-                qp.drawLine(0, yp, ticklen * 0.5, yp)
-                qp.drawText(ticklen, yp + 4, str(tick))
-
-                qp.setPen(grid_major_pen)
-                qp.drawLine(ticklen * 0.5, yp, self.width(), yp)
+            ticks.append(QLineF(0, 0, 0, h - bgap))
+            labels.append((QPointF(ticklen, 15), '[dB]'))
+            yps = toPixelArrays(w, h, np.zeros(len(majors)), self.xaxis, majors, axis)[1]
+            for tick, yp in zip(majors, yps.tolist()):
+                ticks.append(QLineF(0, yp, ticklen * 0.5, yp))
+                labels.append((QPointF(ticklen, yp + 4), str(tick)))
+                major_grid.append(QLineF(ticklen * 0.5, yp, w, yp))
 
         elif axis.type == 'right':
             n = 11
             majors = np.linspace(axis.min, axis.max, n)
-            qp.drawLine(self.rect.topRight(), self.rect.bottomRight())
-            for tick in majors:
-                yp = toPixelCords(w, h, 0, xaxis, tick, axis).y()
-                qp.drawLine(self.width() - ticklen * 0.5, yp,
-                            self.width(), yp)
-                qp.drawText(self.width() - ticklen - 10, yp + 4, str(int(tick)))
-       
+            ticks.append(QLineF(self.rect.topRight(), self.rect.bottomRight()))
+            yps = toPixelArrays(w, h, np.zeros(n), self.xaxis, majors, axis)[1]
+            for tick, yp in zip(majors, yps.tolist()):
+                ticks.append(QLineF(w - ticklen * 0.5, yp, w, yp))
+                labels.append((QPointF(w - ticklen - 10, yp + 4), str(int(tick))))
+
+        self.ticks[axis.type] = (ticks, major_grid, minor_grid, labels)
+        return self.ticks[axis.type]
+
+    def drawTicks(self, qp, axis):
+        ticks, major_grid, minor_grid, labels = self.tickGeometry(axis)
+
+        qp.setPen(self.tick_pen)
+        qp.drawLines(ticks)
+        for pos, text in labels:
+            qp.drawText(pos, text)
+
+        if major_grid:
+            qp.setPen(self.grid_major_pen)
+            qp.drawLines(major_grid)
+        if minor_grid:
+            qp.setPen(self.grid_minor_pen)
+            qp.drawLines(minor_grid)
+
 class MainWindow(QWidget):
     def __init__(self, *args):
         QWidget.__init__(self, *args)
@@ -349,12 +422,21 @@ class MainWindow(QWidget):
         open_btn.clicked.connect(self.onOpenBtnClick)
         self.path_label = QLabel('')
         self.loop_box = QCheckBox('Loop')
+        self.loop_box.toggled.connect(self.onLoopToggled)
+        self.linear_box = QCheckBox('Linear phase')
+        self.linear_box.toggled.connect(self.onLinearPhaseToggled)
+        self.profile_box = QCheckBox('Profile')
+        self.profile_box.toggled.connect(self.onProfileToggled)
         play_btn = QPushButton('Play')
         play_btn.clicked.connect(self.onPlayBtnClick)
         stop_btn = QPushButton('Stop')
         stop_btn.clicked.connect(self.onStopBtnClick)
         save_btn = QPushButton('Apply EQ and save')
         save_btn.clicked.connect(self.onSaveBtnClick)
+        load_preset_btn = QPushButton('Load preset')
+        load_preset_btn.clicked.connect(self.onLoadPresetClick)
+        save_preset_btn = QPushButton('Save preset')
+        save_preset_btn.clicked.connect(self.onSavePresetClick)
 
         trackctrl_layout = QHBoxLayout()
         trackctrl_layout.addWidget(open_btn)
@@ -362,7 +444,13 @@ class MainWindow(QWidget):
         trackctrl_layout.addWidget(play_btn)
         trackctrl_layout.addWidget(stop_btn)
         trackctrl_layout.addWidget(self.loop_box)
+        trackctrl_layout.addWidget(self.linear_box)
+        trackctrl_layout.addWidget(self.profile_box)
+        self.xrun_label = QLabel('')
+        trackctrl_layout.addWidget(self.xrun_label)
         trackctrl_layout.addSpacing(50)
+        trackctrl_layout.addWidget(load_preset_btn)
+        trackctrl_layout.addWidget(save_preset_btn)
         trackctrl_layout.addWidget(save_btn)        
         layout.addLayout(trackctrl_layout)
 
@@ -381,50 +469,50 @@ class MainWindow(QWidget):
         sub_layout.addLayout(labels_layout)
 
         self.nodes = []
-        deffs = [100, 1000, 3000, 5000, 15000]
-        for i in range(0,5):
-            filter_list = QComboBox()
-            filter_list.addItems(list(filterTypes.values()))
-            if i == 0:
-                filter_list.setCurrentIndex(FilterType.HPBrickwall)
-            elif i == 4:
-                filter_list.setCurrentIndex(FilterType.LPBrickwall)
-            else:
-                filter_list.setCurrentIndex(FilterType.Peak)
-
-            checkbox = QCheckBox('On')
-            freq_txt = QLineEdit(str(deffs[i]))
-            freq_txt.setValidator(QIntValidator(self.plotwin.xaxis.min,
-                                               self.plotwin.xaxis.max, self))
-            gain_txt = QLineEdit('0')
-            gain_txt.setValidator(QDoubleValidator(-12, 12, 1, self))
-            q_slider = QSlider(Qt.Horizontal)
-            node = NodeLayout(i, self)
-            node.addControls(checkbox, filter_list, freq_txt, gain_txt, q_slider)
-            node.setControlsEnabled(False)
-            self.nodes.append(node)
-            sub_layout.addLayout(node)
-            
-            node.enabled.connect(self.onFilterEnableChange)
-            node.updated.connect(self.paramChanged)
+        self.nodes_layout = QHBoxLayout()
+        nodes_widget = QWidget()
+        nodes_widget.setLayout(self.nodes_layout)
+        # more bands than fit the window scroll horizontally
+        scroll = QScrollArea()
+        scroll.setFrameStyle(QFrame.NoFrame)
+        scroll.setWidgetResizable(True)
+        scroll.setWidget(nodes_widget)
+        sub_layout.addWidget(scroll)
+
+        band_layout = QVBoxLayout()
+        add_btn = QPushButton('Add band')
+        add_btn.clicked.connect(self.onAddBandClick)
+        remove_btn = QPushButton('Remove band')
+        remove_btn.clicked.connect(self.onRemoveBandClick)
+        band_layout.addWidget(add_btn)
+        band_layout.addWidget(remove_btn)
+        band_layout.addStretch()
+        sub_layout.addLayout(band_layout)
 
         layout.addLayout(sub_layout)
         #------------------------------------
         self.setLayout(layout)
 
         #----------- Filters ----------------
-        self.chain = FilterChain()
-        deffs = [fc * 2 / fs for fc in deffs]
-        self.chain._filters.append(Filter(FilterType.HPBrickwall, deffs[0], enabled = False))
-        self.chain._filters.append(Filter(FilterType.Peak, deffs[1], enabled = False))
-        self.chain._filters.append(Filter(FilterType.Peak, deffs[2], enabled = False))
-        self.chain._filters.append(Filter(FilterType.Peak, deffs[3], enabled = False))
-        self.chain._filters.append(Filter(FilterType.LPBrickwall, deffs[4], enabled = False))
+        self.chain = FilterChain(fs = fs)
+        deffs = [100, 1000, 3000, 5000, 15000]
+        self.addBand(0, Filter(FilterType.HPBrickwall, deffs[0], enabled = False))
+        self.addBand(1, Filter(FilterType.Peak, deffs[1], enabled = False))
+        self.addBand(2, Filter(FilterType.Peak, deffs[2], enabled = False))
+        self.addBand(3, Filter(FilterType.Peak, deffs[3], enabled = False))
+        self.addBand(4, Filter(FilterType.LPBrickwall, deffs[4], enabled = False))
         self.updateChainTF()
         self.plotwin.updateHandles()
 
         self.stream = None
+        self.player = None
+        self.analyzer = None
         self.wf = None
+        self.file_name = None
+
+        self.display_timer = QTimer(self)
+        self.display_timer.timeout.connect(self.onDisplayTimer)
+        self.display_timer.start(int(1000 / self.plotwin.refresh_rate))
 
     @Slot()
     def onOpenBtnClick(self):
@@ -434,13 +522,18 @@ class MainWindow(QWidget):
         if dialog.exec_():
             file_name = dialog.selectedFiles()[0]
             self.path_label.setText(file_name)
-            self.wf = wave.open(file_name,'rb')
+            self.file_name = file_name
+            if self.wf is not None:
+                self.closeStream()
+                self.wf.close()
+            self.wf = WavReader(file_name)
+            self.setSampleRate(self.wf.getframerate())
             self.openStream()
 
     @Slot()
     def onPlayBtnClick(self):
         if self.stream:
-            if self.wf.tell() == self.wf.getnframes() * self.wf.getnchannels():
+            if self.player.done():
                 self.wf.rewind()
                 self.openStream()
             else:
@@ -459,17 +552,136 @@ class MainWindow(QWidget):
         dialog.setNameFilter('Audio (*.wav)')
         if dialog.exec_():
             file_name = dialog.selectedFiles()[0] + '.wav'
-            ww = wave.open(file_name,'wb')
-            wf = self.wf
-            ww.setframerate(wf.getframerate())
-            ww.setsampwidth(wf.getsampwidth())
-            ww.setnchannels(wf.getnchannels())
-            self.wf.rewind()
-            self.chain.reset()
-
-            data = wf.readframes(wf.getnframes())
-            s = self.chain.filter(pcmToFloat(byteToPCM(data,wf.getsampwidth())))
-            ww.writeframes(bytes(floatToPCM(s)))
+            progress = QProgressDialog('Rendering ' + file_name, None, 0, 1000, self)
+            progress.setWindowModality(Qt.WindowModal)
+            def onProgress(done, total):
+                progress.setValue(int(1000 * done / max(total, 1)))
+                QApplication.processEvents()
+
+            # playback keeps running on the original chain
+            stats = renderFile(copy.deepcopy(self.chain), self.file_name, file_name, progress = onProgress)
+            progress.close()
+            if stats['clipped']:
+                QMessageBox.warning(self, 'EQ', '{} samples clipped, peak {:.1f} dBFS'.format(
+                    stats['clipped'], stats['peak_dBFS']))
+
+    def addBand(self, i, filt):
+        """
+        Inserts filt into the chain before band i, with its controls.
+        """
+        self.chain.insertFilt(i, filt, ramp = True)
+        filt = self.chain._filters[i]
+
+        filter_list = QComboBox()
+        filter_list.addItems(list(filterTypes.values()))
+        filter_list.setCurrentIndex(filt._type)
+        checkbox = QCheckBox('On')
+        checkbox.setChecked(filt._enabled)
+        freq_txt = QLineEdit(str(int(filt._fc)))
+        freq_txt.setValidator(QIntValidator(self.plotwin.xaxis.min,
+                                           self.plotwin.xaxis.max, self))
+        gain_txt = QLineEdit('{:.1f}'.format(filt._g))
+        gain_txt.setValidator(QDoubleValidator(-12, 12, 1, self))
+        q_slider = QSlider(Qt.Horizontal)
+        node = NodeLayout(i, self)
+        node.addControls(checkbox, filter_list, freq_txt, gain_txt, q_slider)
+        node.widget = QWidget()
+        node.widget.setLayout(node)
+        node.enabled.connect(self.onFilterEnableChange)
+        node.updated.connect(self.paramChanged)
+
+        self.nodes.insert(i, node)
+        self.nodes_layout.insertWidget(i, node.widget)
+        self.reindexNodes()
+        if filt._enabled:
+            self.updateControls(i, filt._type)
+            self.adjustSliderRange(i, filt._type)
+            self.updateSliderLabel(i)
+        else:
+            node.setControlsEnabled(False)
+
+    def removeBand(self, i):
+        self.chain.removeFilt(i, ramp = True)
+        node = self.nodes.pop(i)
+        self.nodes_layout.removeWidget(node.widget)
+        node.widget.deleteLater()
+        self.reindexNodes()
+
+    def reindexNodes(self):
+        for i, node in enumerate(self.nodes):
+            node.index = i
+
+    @Slot()
+    def onAddBandClick(self):
+        # a peak filter half way (in log frequency) to the next band
+        i = self.plotwin.focused % len(self.nodes) + 1 if self.nodes else 0
+        lo = self.chain._filters[i - 1]._fc if i > 0 else self.plotwin.xaxis.min
+        hi = self.chain._filters[i]._fc if i < len(self.nodes) else self.plotwin.xaxis.max
+        self.addBand(i, Filter(FilterType.Peak, np.sqrt(lo * hi), fs = self.chain.fs()))
+        self.plotwin.focused = i
+        self.plotwin.updateHandles()
+        self.updateChainTF()
+
+    @Slot()
+    def onRemoveBandClick(self):
+        if not self.nodes:
+            return
+        self.removeBand(self.plotwin.focused % len(self.nodes))
+        self.plotwin.focused = min(self.plotwin.focused, len(self.nodes) - 1)
+        self.plotwin.updateHandles()
+        self.updateChainTF()
+
+    @Slot()
+    def onLoadPresetClick(self):
+        file_name = QFileDialog.getOpenFileName(self, 'Load preset', '', 'Preset (*.json)')[0]
+        if not file_name:
+            return
+        try:
+            chain = chainFromPreset(*readPreset(file_name))
+        except (IOError, ValueError, KeyError) as e:
+            QMessageBox.warning(self, 'EQ', 'Cannot load preset: {}'.format(e))
+            return
+        while self.nodes:
+            self.removeBand(len(self.nodes) - 1)
+        # bands are redesigned if the preset was saved for another rate
+        for i, filt in enumerate(chain._filters):
+            self.addBand(i, filt)
+        self.plotwin.focused = -1
+        self.plotwin.updateHandles()
+        self.updateChainTF()
+
+    @Slot()
+    def onSavePresetClick(self):
+        file_name = QFileDialog.getSaveFileName(self, 'Save preset', '', 'Preset (*.json)')[0]
+        if file_name:
+            if not file_name.endswith('.json'):
+                file_name += '.json'
+            savePreset(self.chain, file_name, coefficients = True)
+
+    @Slot()
+    def onProfileToggled(self, checked):
+        # timings are shown over the plot while enabled and can be saved
+        # as JSON when profiling is switched off
+        if checked:
+            profiler.reset()
+            profiler.enabled = True
+        else:
+            profiler.enabled = False
+            file_name = QFileDialog.getSaveFileName(self, 'Save profile', '', 'JSON (*.json)')[0]
+            if file_name:
+                profiler.dump(file_name)
+        self.plotwin.update()
+
+    @Slot()
+    def onLoopToggled(self, checked):
+        # the player's worker thread only reads the flag, never the widget
+        if self.player:
+            self.player.loop = checked
+
+    @Slot()
+    def onLinearPhaseToggled(self, checked):
+        # the response shown is the same, only the phase (and latency) changes
+        self.chain.setLinearPhase(8191 if checked else 0)
 
     @Slot()
     def onFilterEnableChange(self, i):        
@@ -482,7 +694,7 @@ class MainWindow(QWidget):
         else:
             self.nodes[i].setControlsEnabled(False)
         
-        self.chain.setFiltEnabled(i, enabled)
+        self.chain.setFiltEnabled(i, enabled, ramp = True)
         self.plotwin.updateHandles() 
         self.updateChainTF()
 
@@ -521,7 +733,7 @@ class MainWindow(QWidget):
             type = val
             Q = 1                      
         elif param == Params.F:
-            fc = int(self.nodes[i].ctrls[2].text()) * 2 / fs
+            fc = int(self.nodes[i].ctrls[2].text())
         elif param == Params.G:
             g = float(self.nodes[i].ctrls[3].text())
         elif param == Params.Q:
@@ -532,7 +744,7 @@ class MainWindow(QWidget):
             elif type == FilterType.LShelving or FilterType.HShelving:
                 Q = val / 100
 
-        self.chain.updateFilt(i, Filter(type, fc, g, Q))
+        self.chain.updateFilt(i, Filter(type, fc, g, Q, fs = self.chain.fs()), ramp = True)
         if param == Params.TYPE:            
             self.updateControls(i, type)
             self.adjustSliderRange(i, type) 
@@ -567,45 +779,74 @@ class MainWindow(QWidget):
 
         self.nodes[index].slider_label.setText(text)
     
+    def setSampleRate(self, rate):
+        self.chain.setSampleRate(rate)
+        self.plotwin.setSampleRate(rate)
+        for node in self.nodes:
+            node.ctrls[2].setValidator(QIntValidator(self.plotwin.xaxis.min,
+                                                     self.plotwin.xaxis.max, self))
+        self.updateChainTF()
+        self.plotwin.updateHandles()
+
     def openStream(self):
 
+        self.closeStream()
         wf = self.wf
         frate = wf.getframerate()
-        sampw = wf.getsampwidth()
-        nchan = wf.getnchannels()
+        chunk_size = int(frate / self.plotwin.refresh_rate)
+        self.chain.reset()
+        self.analyzer = SpectrumAnalyzer(frate)
+        self.player = Player(wf, self.chain, chunk_size, loop = self.loop_box.isChecked(),
+                             analyzer = self.analyzer)
+        player = self.player
         def callback(in_data, frame_count, time_info, status):
+            if player.done():
+                return b'', pyaudio.paComplete
+            return player.read(frame_count), pyaudio.paContinue
 
-            data = wf.readframes(frame_count)
-            if type(data) == type(''):
-                data = str.encode(data)            
-            if len(data) < frame_count * sampw * nchan:
-                if self.loop_box.isChecked():
-                    wf.rewind()                    
-                    data = b''.join([data,
-                                     wf.readframes(frame_count - int(len(data) / (sampw * nchan)))])
-                    self.chain.reset()
-                elif len(data) == 0:
-                    return data, pyaudio.paComplete
- 
-            filtered = self.chain.filter(pcmToFloat(byteToPCM(data,sampw)))
-            self.plotwin.updateSpectrum(np.fft.rfft(filtered))                
-                
-            return bytes(floatToPCM(filtered)), pyaudio.paContinue
-        
-        chunk_size = np.int(frate / self.plotwin.refresh_rate)
-        self.stream = pya.open(format = pya.get_format_from_width(wf.getsampwidth()),
+        self.player.start()
+        if player.out_float:
+            format = pyaudio.paFloat32
+        else:
+            format = pya.get_format_from_width(player.out_width)
+        self.stream = pya.open(format = format,
                                     channels = wf.getnchannels(),
                                     rate = frate,
                                     frames_per_buffer = chunk_size,
                                     output = True,
                                     stream_callback = callback)
 
-        self.chain.reset()
+    def closeStream(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        if self.player:
+            self.player.stop()
+            self.player = None
+
+    @Slot()
+    def onDisplayTimer(self):
+        player = self.player
+        if player is None:
+            return
+        if player.error is not None:
+            error = player.error
+            self.closeStream()
+            QMessageBox.warning(self, 'EQ', 'Playback stopped: {}: {}'.format(type(error).__name__, error))
+            return
+        with profiler.timer('fft'):
+            updated = self.analyzer.update()
+        if updated:
+            self.plotwin.updateSpectrum(*self.analyzer.spectrum())
+        elif profiler.enabled:
+            self.plotwin.update()
+        self.xrun_label.setText('Underruns: {}  Clipped: {}'.format(player.underruns,
+                                                                   player.quantizer.stats()['clipped']))
 
     def updateChainTF(self):
    
-        w, H = sosfreqz(self.chain.sos(), self.plotwin.wor)
-        self.plotwin.TFcurv.setData(w * 0.5 / np.pi * fs, 20 * np.log10(np.abs(H) + eps))
+        H = self.chain.magnitude(self.plotwin.grid)
+        self.plotwin.TFcurv.setData(self.plotwin.wor * 0.5 / np.pi * self.plotwin.fs, 20 * np.log10(H + eps))
         self.plotwin.update()
 
 class App(QApplication):
@@ -617,6 +858,7 @@ class App(QApplication):
         win.show()
         self.exec_()
 
-pya = pyaudio.PyAudio()
-app = App([])
-pya.terminate()
\ No newline at end of file
+if __name__ == '__main__':
+    pya = pyaudio.PyAudio()
+    app = App([])
+    pya.terminate()
@@ -0,0 +1,181 @@
+import threading
+import time
+import numpy as np
+from utility import byteToPCM, pcmToFloat, deinterleave, interleave, Quantizer
+from profiling import profiler
+
+# Real-time playback support
+# A worker thread reads and filters the wave file ahead of time into a ring
+# buffer; the audio callback only copies bytes out of it. Nothing that can
+# allocate much, design filters or touch Qt runs on the audio thread.
+
+class RingBuffer:
+    """
+    Preallocated single-producer/single-consumer byte ring buffer.
+    The producer only advances the write count and the consumer only the
+    read count, so the two threads never need a lock.
+    """
+    def __init__(self, capacity):
+        self._buf = np.zeros(capacity, dtype = np.uint8)
+        self._cap = capacity
+        self._w = 0
+        self._r = 0
+
+    def readable(self):
+        return self._w - self._r
+
+    def writable(self):
+        return self._cap - (self._w - self._r)
+
+    def write(self, data):
+        """
+        Copies as much of data as fits, returns the number of bytes written.
+        """
+        src = np.frombuffer(data, dtype = np.uint8)
+        n = min(len(src), self.writable())
+        start = self._w % self._cap
+        first = min(n, self._cap - start)
+        self._buf[start:start+first] = src[:first]
+        self._buf[:n-first] = src[first:n]
+        self._w += n
+        return n
+
+    def read(self, out):
+        """
+        Fills the uint8 array out as far as possible, returns the number
+        of bytes read.
+        """
+        n = min(len(out), self.readable())
+        start = self._r % self._cap
+        first = min(n, self._cap - start)
+        out[:first] = self._buf[start:start+first]
+        out[first:n] = self._buf[:n-first]
+        self._r += n
+        return n
+
+class Player:
+    """
+    Pre-renders filtered blocks of a wave file for the audio callback.
+
+    Inputs:
+        wf : WavReader (or wave file) opened for reading
+        chain : FilterChain applied to the audio
+        block_frames : frames per callback
+        blocks : ring buffer size in blocks, i.e. how far ahead the worker
+            renders (and so how late parameter changes are heard)
+        loop : True to start over at the end of the file; a plain flag
+            that the GUI sets, read by the worker thread
+        analyzer : optional SpectrumAnalyzer fed with the filtered audio
+    """
+    def __init__(self, wf, chain, block_frames, blocks = 4, loop = False, analyzer = None):
+        self.wf = wf
+        self.chain = chain
+        self.block_frames = block_frames
+        self.loop = loop
+        self.analyzer = analyzer
+        self._isfloat = getattr(wf, 'isfloat', lambda: False)()
+        # sound devices take float32 at most, float64 files are played as such
+        self.out_float = self._isfloat
+        self.out_width = 4 if self._isfloat else wf.getsampwidth()
+        self._frame_bytes = self.out_width * wf.getnchannels()
+        self._in_frame_bytes = wf.getsampwidth() * wf.getnchannels()
+        self.quantizer = Quantizer(self.out_width, self.out_float, channels = wf.getnchannels())
+        self._ring = RingBuffer(blocks * block_frames * self._frame_bytes)
+        self._out = bytearray(block_frames * self._frame_bytes)
+        self._space = threading.Event()
+        self._running = False
+        self._thread = None
+
+        self.finished = False
+        self.error = None
+        self.underruns = 0
+        self.underrun_frames = 0
+
+    def start(self):
+        # fill the ring before the first callback asks for audio
+        block_bytes = self.block_frames * self._frame_bytes
+        while self._ring.writable() >= block_bytes and self._renderBlock():
+            pass
+
+        self._running = True
+        self._thread = threading.Thread(target = self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._space.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _readBlock(self):
+        wf = self.wf
+        data = wf.readframes(self.block_frames)
+        if len(data) < self.block_frames * self._in_frame_bytes and self.loop:
+            wf.rewind()
+            rest = wf.readframes(self.block_frames - len(data) // self._in_frame_bytes)
+            data = np.concatenate((np.frombuffer(data, dtype = np.uint8), np.frombuffer(rest, dtype = np.uint8)))
+            self.chain.reset()
+        return data
+
+    def _renderBlock(self):
+        # returns False once the end of the file has been reached
+        start = time.perf_counter()
+        with profiler.timer('read'):
+            data = self._readBlock()
+        if len(data) == 0:
+            self.finished = True
+            return False
+
+        nchan = self.wf.getnchannels()
+        with profiler.timer('filter'):
+            sig = pcmToFloat(byteToPCM(data, self.wf.getsampwidth(), self._isfloat), self.chain.precision())
+            filtered = self.chain.filter(deinterleave(sig, nchan))
+        if self.analyzer is not None:
+            with profiler.timer('feed'):
+                self.analyzer.feed(filtered)
+        with profiler.timer('quantize'):
+            self._ring.write(self.quantizer.quantize(interleave(filtered)))
+        # a block must be rendered in less than its playing time
+        profiler.record('render', time.perf_counter() - start, self.block_frames / self.wf.getframerate())
+        return True
+
+    def _run(self):
+        block_bytes = self.block_frames * self._frame_bytes
+        try:
+            while self._running:
+                self._space.clear()
+                if self._ring.writable() < block_bytes:
+                    self._space.wait(0.1)
+                elif not self._renderBlock():
+                    return
+        except Exception as e:
+            # playback ends with what is buffered, the GUI reports error
+            self.error = e
+            self.finished = True
+
+    def done(self):
+        return self.finished and self._ring.readable() == 0
+
+    def read(self, frame_count):
+        """
+        Called from the audio callback: returns frame_count frames of
+        filtered audio. Missing frames (underrun) are played as silence.
+        """
+        start = time.perf_counter()
+        nbytes = frame_count * self._frame_bytes
+        if nbytes > len(self._out):
+            self._out = bytearray(nbytes)
+        out = np.frombuffer(self._out, dtype = np.uint8, count = nbytes)
+
+        n = self._ring.read(out)
+        self._space.set()
+        if n < nbytes:
+            out[n:] = 0
+            if not self.finished:
+                self.underruns += 1
+                self.underrun_frames += (nbytes - n) // self._frame_bytes
+        out = bytes(out)
+        profiler.record('callback', time.perf_counter() - start, frame_count / self.wf.getframerate())
+        return out
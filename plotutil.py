@@ -0,0 +1,69 @@
+from numpy import log10, asarray, empty, array
+from PySide.QtCore import QPoint, QByteArray, QDataStream
+from PySide.QtGui import QPolygonF
+
+def toPixelCords(width, height, x, xaxis, y = 0, yaxis = None):
+    xmin = xaxis.min
+    xmax = xaxis.max       
+
+    if xaxis.log:
+        xp = log10(x / xmin + 0.000001) / log10(xmax / xmin) * width
+    else:
+        xp = (x - xmin) / (xmax - xmin) * width
+    if yaxis != None:
+        ymin = yaxis.min
+        ymax = yaxis.max
+        yp = (y - ymax) / (ymin - ymax) * height
+        return QPoint(xp, yp)
+    else:
+        return xp
+
+def toPixelArrays(width, height, x, xaxis, y = None, yaxis = None):
+    """
+    Array version of toPixelCords: maps whole x (and y) arrays to pixel
+    coordinates at once. Returns xp, or (xp, yp) when yaxis is given.
+    """
+    xmin = xaxis.min
+    xmax = xaxis.max
+    x = asarray(x, dtype = 'float64')
+
+    if xaxis.log:
+        xp = log10(x / xmin + 0.000001) * (width / log10(xmax / xmin))
+    else:
+        xp = (x - xmin) * (width / (xmax - xmin))
+    if yaxis is None:
+        return xp
+    yp = (asarray(y, dtype = 'float64') - yaxis.max) * (height / (yaxis.min - yaxis.max))
+    return xp, yp
+
+def toPolygon(xp, yp):
+    """
+    Builds a QPolygonF from arrays of pixel coordinates.
+    """
+    # the polygon is read from a buffer in QDataStream's format for
+    # QVector<QPointF> (big-endian point count, then x, y doubles), so
+    # no QPointF is created per point
+    n = len(xp)
+    points = empty((n, 2), dtype = '>f8')
+    points[:, 0] = xp
+    points[:, 1] = yp
+    data = array([n], dtype = '>u4').tobytes() + points.tobytes()
+    poly = QPolygonF()
+    QDataStream(QByteArray(data)) >> poly
+    return poly
+
+def fromPixelCords(width, height, point, xaxis, yaxis):
+    xmin = xaxis.min
+    xmax = xaxis.max
+    ymin = yaxis.min
+    ymax = yaxis.max
+
+    xp = point.x()
+    yp = point.y()
+
+    if xaxis.log:
+        x = 10 ** (xp * log10(xmax / xmin) / width + log10(xmin))
+    else:
+        x = xp * (xmax - xmin) / width + xmin
+    y = yp * (ymin - ymax) / height + ymax
+    return x, y
@@ -0,0 +1,152 @@
+import hashlib
+import json
+import os
+import numpy as np
+from filters import FilterType, Filter, FilterChain, designCache, designVersion, normalizedFc
+
+# Presets are JSON files describing the filters of a chain:
+#
+#   {"fs": 44100,
+#    "filters": [{"type": "HPBrickwall", "fc": 100, "enabled": true},
+#                {"type": "Peak", "fc": 1000, "gain": 3.0, "Q": 1.5}]}
+#
+# type is a FilterType attribute name and fc is given in Hz; fs is the
+# sample rate the chain is designed for until it is changed with
+# FilterChain.setSampleRate. gain, Q and enabled default to the Filter
+# constructor values.
+#
+# An optional "automation" list changes filters during offline renders:
+#
+#   "automation": [{"time": 2.5, "index": 1, "type": "Peak", "fc": 2000, "gain": -3.0}]
+#
+# replaces filter 1 of the chain 2.5 s into the file, with a short
+# crossfade (FilterChain.ramp_time). The filter fields are as above.
+#
+# Presets may carry the designed coefficients for fs in a binary file
+# next to them, so that loading does not design any filter:
+#
+#   "coefficients": {"file": "preset.sos", "hash": "3f0c...", "sections": [6, 1]}
+#
+# The file holds the second-order sections of all filters in order, as
+# little-endian float64 rows of 6, sections gives their number per filter.
+# hash covers the design version, the design parameters, the section
+# counts and the coefficients themselves (see presetHash); coefficients
+# that do not match it, e.g. a stale or damaged file, are ignored and the
+# filters designed as usual.
+
+_typeNames = {v: k for k, v in vars(FilterType).items() if not k.startswith('_')}
+
+def _filterParams(p, fs):
+    if not p['type'] in vars(FilterType):
+        raise ValueError('unknown filter type: ' + str(p['type']))
+    return (getattr(FilterType, p['type']), p['fc'], p.get('gain', 0),
+            p.get('Q', 1), p.get('enabled', True), fs)
+
+def _filterFromDict(p, fs):
+    return Filter(*_filterParams(p, fs))
+
+def presetHash(preset, sections, sos):
+    """
+    Hash of the stored coefficients sos, split into sections per filter,
+    together with everything they depend on: the design version and the
+    quantized design parameters at fs.
+    """
+    fs = preset.get('fs', 44100)
+    keys = []
+    for p in preset['filters']:
+        type, fc, gain, Q, enabled, fs = _filterParams(p, fs)
+        keys.append(designCache.key(type, normalizedFc(fc, fs), gain, Q))
+    data = json.dumps([designVersion, fs, keys, list(sections)]).encode()
+    return hashlib.sha1(data + np.ascontiguousarray(sos, dtype = '<f8').tobytes()).hexdigest()
+
+def _storedSections(preset, coefficients):
+    # the coefficients of every filter if they are complete and match the
+    # preset, else None
+    info = preset.get('coefficients')
+    if coefficients is None or info is None:
+        return None
+    sections = info.get('sections', [])
+    if len(sections) != len(preset['filters']) or sum(sections) != len(coefficients) \
+            or info.get('hash') != presetHash(preset, sections, coefficients):
+        return None
+    ends = np.cumsum(sections)
+    return [coefficients[end - m:end] for m, end in zip(sections, ends)]
+
+def chainFromPreset(preset, coefficients = None):
+    """
+    Builds a FilterChain from an already parsed preset dictionary.
+    coefficients are the stored sections of the preset, see loadPreset;
+    they are given to the filters if they match the preset and its hash.
+    """
+    fs = preset.get('fs', 44100)
+    chain = FilterChain(fs = fs)
+    stored = _storedSections(preset, coefficients)
+    if stored is not None:
+        for p, sos in zip(preset['filters'], stored):
+            chain.addFilt(Filter(*_filterParams(p, fs), sos = sos))
+        return chain
+
+    for p in preset['filters']:
+        chain.addFilt(_filterFromDict(p, fs))
+    return chain
+
+def automationFromPreset(preset):
+    """
+    Returns the automation events of a parsed preset as a list of
+    (seconds, index, Filter), as taken by render.renderFile.
+    """
+    fs = preset.get('fs', 44100)
+    nfilters = len(preset['filters'])
+    events = []
+    for p in preset.get('automation', []):
+        if not 0 <= p['index'] < nfilters:
+            raise ValueError('automation index out of range: ' + str(p['index']))
+        events.append((p['time'], p['index'], _filterFromDict(p, fs)))
+    return events
+
+def presetFromChain(chain):
+    filters = []
+    for filt in chain._filters:
+        filters.append({'type': _typeNames[filt._type], 'fc': filt._fc,
+                        'gain': filt._g, 'Q': filt._Q, 'enabled': filt._enabled})
+    return {'fs': chain.fs(), 'filters': filters}
+
+def _coefficientsPath(path, preset):
+    info = preset.get('coefficients')
+    if info is None:
+        return None
+    return os.path.join(os.path.dirname(path), info['file'])
+
+def readPreset(path):
+    """
+    Returns (preset dictionary, stored coefficients or None).
+    """
+    with open(path) as f:
+        preset = json.load(f)
+    sos_path = _coefficientsPath(path, preset)
+    if sos_path is None or not os.path.exists(sos_path):
+        return preset, None
+    sos = np.fromfile(sos_path, dtype = '<f8')
+    if len(sos) % 6:
+        return preset, None
+    return preset, sos.reshape(-1, 6)
+
+def loadPreset(path):
+    return chainFromPreset(*readPreset(path))
+
+def savePreset(chain, path, coefficients = False):
+    """
+    Saves the filters of chain as a preset; with coefficients, their
+    designed sections are stored alongside (path with extension .sos).
+    """
+    preset = presetFromChain(chain)
+    if coefficients:
+        sos_path = os.path.splitext(path)[0] + '.sos'
+        sections = [filt._sos.shape[0] for filt in chain._filters]
+        sos = np.concatenate([filt._sos for filt in chain._filters]) if chain._filters \
+            else np.empty((0, 6))
+        preset['coefficients'] = {'file': os.path.basename(sos_path), 'sections': sections,
+                                  'hash': presetHash(preset, sections, sos)}
+        sos.astype('<f8').tofile(sos_path)
+    with open(path, 'w') as f:
+        json.dump(preset, f, indent = 1)
@@ -0,0 +1,158 @@
+import json
+import math
+import threading
+import time
+from filters import designCache
+
+# Lightweight instrumentation of the processing stages
+# Code under test wraps a stage in `with profiler.timer('name'):` or
+# reports a duration with profiler.record. Durations go into fixed
+# log-spaced histograms (20 bins per decade from 100 ns to 100 s), so
+# recording costs a few hundred nanoseconds and no memory grows with
+# time; percentiles are read from the histograms. Stages given a budget
+# count the runs over it as deadline misses.
+#
+# While profiler.enabled is False, timer() returns a shared no-op context
+# and record() returns at once.
+
+_bins_per_decade = 20
+_min_exp = -7
+_nbins = 9 * _bins_per_decade
+
+class Stage:
+    def __init__(self, name, budget = None):
+        self.name = name
+        self.budget = budget
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * _nbins
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.misses = 0
+
+    def record(self, seconds):
+        if seconds > 0:
+            i = int((math.log10(seconds) - _min_exp) * _bins_per_decade)
+            i = min(max(i, 0), _nbins - 1)
+        else:
+            i = 0
+        self.counts[i] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        if self.budget is not None and seconds > self.budget:
+            self.misses += 1
+
+    def percentile(self, p):
+        """
+        Upper bound of the p-th percentile (0-100) in seconds, within the
+        bin resolution of about 12%.
+        """
+        if self.count == 0:
+            return 0.0
+        rank = p / 100 * self.count
+        n = 0
+        for i, c in enumerate(self.counts):
+            n += c
+            if n >= rank and c:
+                return min(10 ** (_min_exp + (i + 1) / _bins_per_decade), self.max)
+        return self.max
+
+    def summary(self):
+        s = {'count': self.count, 'mean': self.total / self.count if self.count else 0.0,
+             'p50': self.percentile(50), 'p90': self.percentile(90), 'p99': self.percentile(99),
+             'max': self.max}
+        if self.budget is not None:
+            s['budget'] = self.budget
+            s['misses'] = self.misses
+        return s
+
+class _Timer:
+    __slots__ = ('_stage', '_start')
+
+    def __init__(self, stage):
+        self._stage = stage
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self._stage.record(time.perf_counter() - self._start)
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+_null = _NullTimer()
+
+class Profiler:
+    def __init__(self):
+        self.enabled = False
+        self._stages = {}
+        self._lock = threading.Lock()
+
+    def stage(self, name, budget = None):
+        """
+        Returns the Stage called name, created on first use; budget (in
+        seconds) is set if given.
+        """
+        stage = self._stages.get(name)
+        if stage is None:
+            with self._lock:
+                stage = self._stages.setdefault(name, Stage(name))
+        if budget is not None:
+            stage.budget = budget
+        return stage
+
+    def timer(self, name):
+        if not self.enabled:
+            return _null
+        return _Timer(self.stage(name))
+
+    def record(self, name, seconds, budget = None):
+        if self.enabled:
+            self.stage(name, budget).record(seconds)
+
+    def _snapshot(self):
+        # stages may be created by other threads while they are listed
+        with self._lock:
+            return sorted(self._stages.items())
+
+    def reset(self):
+        for name, stage in self._snapshot():
+            stage.reset()
+
+    def report(self):
+        """
+        Returns the summaries of all stages and the design cache stats.
+        """
+        stages = {name: stage.summary() for name, stage in self._snapshot()}
+        return {'stages': stages, 'design_cache': designCache.stats()}
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent = 1)
+
+    def lines(self):
+        """
+        One line of text per stage, for an on-screen overlay.
+        """
+        lines = []
+        for name, s in self._snapshot():
+            text = '{:<10} p50 {:7.3f}  p99 {:7.3f}  max {:7.3f} ms'.format(
+                name, s.percentile(50) * 1e3, s.percentile(99) * 1e3, s.max * 1e3)
+            if s.budget is not None:
+                text += '  misses {}'.format(s.misses)
+            lines.append(text)
+        d = designCache.stats()
+        lines.append('design cache: {} hits, {} misses'.format(d['hits'], d['misses']))
+        return lines
+
+profiler = Profiler()
@@ -0,0 +1,134 @@
+"""
+Headless pyEQ entry point, usable without PySide or pyaudio:
+
+    python -m pyeq render preset.json in/*.wav out/
+    python -m pyeq serve --socket /tmp/pyeq.sock
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+from preset import readPreset, chainFromPreset, automationFromPreset
+from render import renderBatch, renderParallel, RenderResult
+from profiling import profiler
+
+def _expand(patterns):
+    # shells that do not expand wildcards (cmd.exe) pass them through
+    paths = []
+    for p in patterns:
+        matches = sorted(glob.glob(p))
+        paths.extend(matches if matches else [p])
+    return paths
+
+def render(args):
+    preset, coefficients = readPreset(args.preset)
+    chain = chainFromPreset(preset, coefficients)
+    if args.linear_phase:
+        chain.setLinearPhase(args.linear_phase)
+    automation = automationFromPreset(preset)
+    if not os.path.isdir(args.out):
+        os.makedirs(args.out)
+
+    jobs = [(in_path, os.path.join(args.out, os.path.basename(in_path)))
+            for in_path in _expand(args.inputs)]
+
+    def report(r):
+        if r.error is None:
+            print('{} -> {} ({:.2f} s, peak {:.1f} dBFS)'.format(r.in_path, r.out_path, r.seconds,
+                                                             r.stats['peak_dBFS']))
+            if r.stats['clipped']:
+                print('{}: {} samples clipped'.format(r.out_path, r.stats['clipped']), file = sys.stderr)
+        else:
+            print('{}: {}'.format(r.in_path, r.error), file = sys.stderr)
+
+    dither = None if args.dither == 'none' else args.dither
+    profiler.enabled = args.profile is not None
+    try:
+        results = _render(args, chain, jobs, automation, dither, report)
+    finally:
+        if args.profile is not None:
+            profiler.dump(args.profile)
+    if results is None:
+        return 2
+    return 1 if any(r.error is not None for r in results) else 0
+
+def _render(args, chain, jobs, automation, dither, report):
+    if not args.split:
+        return renderBatch(chain, jobs, args.jobs, args.block, report, args.rate, dither, automation,
+                           args.precision)
+
+    if args.rate is not None or automation:
+        print('--split supports neither --rate nor automation', file = sys.stderr)
+        return None
+    # one file after the other, each split over the workers
+    results = []
+    for in_path, out_path in jobs:
+        start = time.perf_counter()
+        stats = None
+        error = None
+        try:
+            stats = renderParallel(chain, in_path, out_path, args.jobs, args.block, dither = dither,
+                                   precision = args.precision)
+        except Exception as e:
+            error = '{}: {}'.format(type(e).__name__, e)
+        results.append(RenderResult(in_path, out_path, time.perf_counter() - start, error, stats))
+        report(results[-1])
+    return results
+
+def serve(args):
+    # asyncio is only needed here
+    import service
+    if args.socket is None and not service.isLoopback(args.host):
+        print('--host must be a loopback address, e.g. 127.0.0.1 or ::1', file = sys.stderr)
+        return 2
+    service.serve(args.socket, args.host, args.port, args.jobs, args.queue)
+    return 0
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(prog = 'pyeq', description = 'pyEQ batch processing')
+    sub = parser.add_subparsers(dest = 'command')
+
+    p = sub.add_parser('render', help = 'apply a preset to wave files')
+    p.add_argument('preset', help = 'preset JSON file')
+    p.add_argument('inputs', nargs = '+', help = 'input wave files or glob patterns')
+    p.add_argument('out', help = 'output directory')
+    p.add_argument('-j', '--jobs', type = int,
+                   help = 'number of worker processes, 0 for one per CPU (default 1, or one per CPU '
+                          'with --split)')
+    p.add_argument('--split', action = 'store_true',
+                   help = 'split every file into segments rendered in parallel, for few long files')
+    p.add_argument('--block', type = int, default = 65536, help = 'frames per block')
+    p.add_argument('--rate', type = int, help = 'resample the output to this sample rate')
+    p.add_argument('--linear-phase', type = int, nargs = '?', const = 8191, default = 0, metavar = 'TAPS',
+                   help = 'apply the magnitude response as a linear-phase FIR (default 8191 taps)')
+    p.add_argument('--precision', choices = ['float32', 'float64'], default = 'float64',
+                   help = 'processing precision (default float64)')
+    p.add_argument('--profile', metavar = 'JSON',
+                   help = 'write per-stage timings to this file (stages run in worker processes with -j > 1 '
+                          'are not included)')
+    p.add_argument('--dither', choices = ['none', 'tpdf', 'hp'], default = 'none',
+                   help = 'dither added before quantizing to PCM; hp shapes it towards high frequencies')
+    p.set_defaults(func = render)
+
+    p = sub.add_parser('serve', help = 'accept render jobs from other programs, see service.py')
+    p.add_argument('--socket', help = 'Unix socket path; localhost TCP if not given')
+    p.add_argument('--host', default = '127.0.0.1', help = 'loopback TCP address (default 127.0.0.1)')
+    p.add_argument('--port', type = int, default = 8765, help = 'TCP port (default 8765)')
+    p.add_argument('-j', '--jobs', type = int, default = 0,
+                   help = 'jobs rendered at once, 0 for one per CPU')
+    p.add_argument('--queue', type = int, default = 64, help = 'jobs allowed to wait (default 64)')
+    p.set_defaults(func = serve)
+
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return 2
+    if args.command == 'render' and args.jobs is None:
+        args.jobs = 0 if args.split else 1
+    if getattr(args, 'jobs', None) == 0:
+        args.jobs = None
+    return args.func(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,277 @@
+import copy
+import os
+import time
+import numpy as np
+from collections import namedtuple, deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from resampler import Resampler
+from utility import byteToPCM, pcmToFloat, deinterleave, interleave, Quantizer
+from wavio import WavReader, WavWriter
+from profiling import profiler
+
+# Offline rendering of a whole wave file through a FilterChain
+# The file is streamed in fixed-size blocks and the chain carries its state
+# from block to block, so peak memory does not depend on the file length.
+
+block_size = 65536
+
+def _filterAutomated(chain, x, start, events):
+    # filters the (channels, frames) block x beginning at input frame start,
+    # applying the events due in it as ramped filter updates
+    pieces = []
+    pos = 0
+    while events and events[0][0] < start + x.shape[-1]:
+        frame, i, filt = events.popleft()
+        at = max(frame - start, 0)
+        if at > pos:
+            pieces.append(chain.filter(x[:, pos:at]))
+            pos = at
+        chain.updateFilt(i, filt, ramp = True)
+    if pos < x.shape[-1]:
+        pieces.append(chain.filter(x[:, pos:]))
+    return pieces[0] if len(pieces) == 1 else np.concatenate(pieces, axis = 1)
+
+def renderFile(chain, in_path, out_path, block_size = block_size, progress = None, rate = None,
+               dither = None, automation = None, precision = 'float64'):
+    """
+    Filters in_path through chain and writes the result to out_path.
+
+    Inputs:
+        chain : FilterChain, reset before rendering
+        in_path, out_path : wave file paths
+        block_size : number of frames read, filtered and written at once
+        progress : optional callable(done, total), called after every
+            block with the number of frames rendered so far
+        rate : optional output sample rate; the chain is designed for the
+            input rate and its output resampled to rate
+        dither : None, 'tpdf' or 'hp', see utility.Quantizer
+        automation : optional list of (seconds, index, Filter) events; at
+            each time filter index of the chain is replaced, crossfading
+            over FilterChain.ramp_time
+        precision : floating point type the chain is set to and the
+            audio is processed in
+
+    Outputs:
+        Quantizer.stats() of the output: clipped samples and peak level
+    """
+    with WavReader(in_path) as wf:
+        sampw = wf.getsampwidth()
+        nchan = wf.getnchannels()
+        frate = wf.getframerate()
+        isfloat = wf.isfloat()
+        chain.setSampleRate(frate)
+        chain.setPrecision(precision)
+        events = deque(sorted(((int(round(t * frate)), i, filt) for t, i, filt in automation or []),
+                              key = lambda e: e[0]))
+        resampler = None
+        if rate is not None and rate != frate:
+            resampler = Resampler(frate, rate, nchan)
+        quantizer = Quantizer(sampw, isfloat, dither, nchan)
+
+        with WavWriter(out_path, nchan, sampw, frate if resampler is None else rate, isfloat) as ww:
+            total = wf.getnframes()
+            chain.reset()
+            # the output stays aligned with the input: the first latency
+            # frames are dropped and as many are flushed out at the end
+            latency = chain.latency()
+            skip = latency
+
+            def write(s):
+                nonlocal skip
+                drop = min(skip, s.shape[-1])
+                skip -= drop
+                s = s[:, drop:]
+                if resampler is not None:
+                    with profiler.timer('resample'):
+                        s = resampler.process(s)
+                with profiler.timer('write'):
+                    ww.writeframes(quantizer.quantize(interleave(s)))
+
+            for start in range(0, total, block_size):
+                stop = min(start + block_size, total)
+                with profiler.timer('read'):
+                    s = pcmToFloat(byteToPCM(wf.frames(start, stop), sampw, isfloat), precision)
+                with profiler.timer('filter'):
+                    s = _filterAutomated(chain, deinterleave(s, nchan), start, events)
+                write(s)
+
+                if progress is not None:
+                    progress(stop, total)
+
+            if latency:
+                write(chain.filter(np.zeros((nchan, latency), dtype = precision)))
+            if resampler is not None:
+                ww.writeframes(quantizer.quantize(interleave(resampler.flush())))
+
+    return quantizer.stats()
+
+# Outcome of one file of a batch; error is None on success, stats are the
+# renderFile output statistics (None on failure)
+RenderResult = namedtuple('RenderResult', ['in_path', 'out_path', 'seconds', 'error', 'stats'])
+
+_chain = None
+
+def _initWorker(chain):
+    # every worker process receives the coefficients once, not per file
+    global _chain
+    _chain = chain
+
+def _renderJob(in_path, out_path, block_size, rate, dither, automation, precision):
+    start = time.perf_counter()
+    stats = None
+    try:
+        # automated filters would otherwise stay in the chain for the next file
+        chain = _chain if not automation else copy.deepcopy(_chain)
+        stats = renderFile(chain, in_path, out_path, block_size, rate = rate, dither = dither,
+                           automation = automation, precision = precision)
+        error = None
+    except Exception as e:
+        error = '{}: {}'.format(type(e).__name__, e)
+    return RenderResult(in_path, out_path, time.perf_counter() - start, error, stats)
+
+def renderBatch(chain, jobs, workers = None, block_size = block_size, progress = None, rate = None,
+                dither = None, automation = None, precision = 'float64'):
+    """
+    Renders many files through chain, in parallel on a process pool.
+
+    Inputs:
+        chain : FilterChain applied to every file
+        jobs : list of (in_path, out_path) pairs
+        workers : number of worker processes, None for one per CPU;
+            1 renders in the calling process
+        progress : optional callable(result), called as each file finishes
+        rate, dither, automation, precision : see renderFile, the same
+            for every file
+
+    Outputs:
+        list of RenderResult in job order. A failing file is reported in
+        its result and does not stop the rest of the batch.
+    """
+    results = [None] * len(jobs)
+
+    if workers == 1:
+        _initWorker(chain)
+        for i, (in_path, out_path) in enumerate(jobs):
+            results[i] = _renderJob(in_path, out_path, block_size, rate, dither, automation, precision)
+            if progress is not None:
+                progress(results[i])
+        return results
+
+    with ProcessPoolExecutor(max_workers = workers, initializer = _initWorker,
+                             initargs = (chain,)) as pool:
+        futures = {}
+        for i, (in_path, out_path) in enumerate(jobs):
+            futures[pool.submit(_renderJob, in_path, out_path, block_size, rate, dither, automation,
+                                  precision)] = i
+
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                results[i] = future.result()
+            except Exception as e:
+                # the worker itself died, e.g. BrokenProcessPool
+                results[i] = RenderResult(jobs[i][0], jobs[i][1], 0, '{}: {}'.format(type(e).__name__, e), None)
+            if progress is not None:
+                progress(results[i])
+    return results
+
+# Parallel rendering of one file
+# The file is cut into segments rendered by separate processes. A chain
+# only remembers its input through decaying state, so a segment starts
+# from silence settleFrames() before its first frame and is accurate by
+# the time its own frames come out. Each worker writes its frames in
+# place into the output file, whose size is reserved up front.
+
+def _renderSegment(in_path, out_path, offset, start, stop, settle, block_size, dither, precision):
+    chain = _chain
+    with WavReader(in_path) as wf:
+        sampw = wf.getsampwidth()
+        nchan = wf.getnchannels()
+        isfloat = wf.isfloat()
+        total = wf.getnframes()
+        chain.setSampleRate(wf.getframerate())
+        chain.setPrecision(precision)
+        chain.reset()
+        quantizer = Quantizer(sampw, isfloat, dither, nchan)
+
+        # input frames are numbered like the output frames they produce
+        # before the latency is dropped
+        latency = chain.latency()
+        first = max(start + latency - settle, 0)
+        with open(out_path, 'r+b') as f:
+            f.seek(offset + start * nchan * sampw)
+            for b0 in range(first, stop + latency, block_size):
+                b1 = min(b0 + block_size, stop + latency)
+                x = np.zeros((nchan, b1 - b0), dtype = precision)
+                if b0 < total:
+                    data = wf.frames(b0, min(b1, total))
+                    s = deinterleave(pcmToFloat(byteToPCM(data, sampw, isfloat), precision), nchan)
+                    x[:, :s.shape[-1]] = s
+                y = chain.filter(x)
+                lo = max(start + latency - b0, 0)
+                if lo < y.shape[-1]:
+                    f.write(quantizer.quantize(interleave(y[:, lo:])))
+    return quantizer.stats()
+
+def renderParallel(chain, in_path, out_path, workers = None, block_size = block_size, progress = None,
+                   dither = None, precision = 'float64', tol = 2.0 ** -24):
+    """
+    Renders one file like renderFile, split into one segment per worker.
+
+    Inputs:
+        chain : FilterChain, not modified
+        workers : number of worker processes, None for one per CPU
+        progress : optional callable(done, total), called as segments
+            finish with the number of frames rendered so far
+        tol : residual of the state pre-roll relative to the signal;
+            the default stays below 24-bit resolution
+        dither, precision : see renderFile
+
+    Outputs:
+        Quantizer.stats() of the output, summed over the segments
+
+    Files too short to gain from splitting (segments shorter than a few
+    times the pre-roll) are rendered serially. Resampling and automation
+    are not supported; use renderFile.
+    """
+    with WavReader(in_path) as wf:
+        nchan = wf.getnchannels()
+        sampw = wf.getsampwidth()
+        frate = wf.getframerate()
+        isfloat = wf.isfloat()
+        total = wf.getnframes()
+
+    chain = copy.deepcopy(chain)
+    chain.setSampleRate(frate)
+    chain.setPrecision(precision)
+    settle = chain.settleFrames(tol)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    length = -(-total // workers)
+    if settle is None or workers == 1 or length < 4 * settle:
+        return renderFile(chain, in_path, out_path, block_size, progress, dither = dither,
+                          precision = precision)
+
+    with WavWriter(out_path, nchan, sampw, frate, isfloat) as ww:
+        offset = ww.reserve(total)
+
+    stats = {'samples': 0, 'clipped': 0, 'peak': 0.0}
+    done = 0
+    with ProcessPoolExecutor(max_workers = workers, initializer = _initWorker,
+                             initargs = (chain,)) as pool:
+        futures = {}
+        for start in range(0, total, length):
+            stop = min(start + length, total)
+            futures[pool.submit(_renderSegment, in_path, out_path, offset, start, stop, settle,
+                                block_size, dither, precision)] = stop - start
+        for future in as_completed(futures):
+            s = future.result()
+            stats['samples'] += s['samples']
+            stats['clipped'] += s['clipped']
+            stats['peak'] = max(stats['peak'], s['peak'])
+            done += futures[future]
+            if progress is not None:
+                progress(done, total)
+
+    stats['peak_dBFS'] = float(20 * np.log10(stats['peak'])) if stats['peak'] > 0 else float('-inf')
+    return stats
@@ -0,0 +1,95 @@
+from math import gcd
+import numpy as np
+from scipy.signal import firwin, kaiserord
+
+# Streaming polyphase sample rate converter
+# Converts by the rational factor L/M = fs_out/fs_in with a Kaiser windowed-
+# sinc prototype of about L * taps coefficients; only the `taps`
+# coefficients of one phase are applied per output sample. The cutoff is at
+# 0.9 times the lower of the two Nyquist frequencies and the stopband, at
+# least `attenuation` dB down, starts at that Nyquist frequency. The
+# prototype has odd length, so its delay is a whole number of samples and
+# is compensated exactly: output sample m lines up with input time
+# m * fs_in / fs_out.
+
+class Resampler:
+    """
+    Inputs:
+        fs_in, fs_out : integer sample rates
+        channels : number of channels of (channels, frames) input
+        taps : filter length per phase, None to derive it from attenuation;
+            longer is sharper and slower
+        attenuation : stopband attenuation in dB when taps is None
+    """
+
+    chunk = 8192 # outputs computed at once, bounds the temporary memory
+
+    def __init__(self, fs_in, fs_out, channels = 1, taps = None, attenuation = 80):
+        g = gcd(int(fs_in), int(fs_out))
+        self.L = int(fs_out) // g
+        self.M = int(fs_in) // g
+        R = max(self.L, self.M)
+
+        # transition band from 0.8 to 1.0 of the lower Nyquist frequency
+        numtaps, beta = kaiserord(attenuation, 0.2 / R)
+        if taps is None:
+            taps = -(-numtaps // self.L)
+        self.taps = taps
+
+        # an odd prototype length, zero-padded to L * taps
+        K = self.L * taps - 1 + (self.L * taps) % 2
+        h = np.zeros(self.L * taps)
+        h[:K] = firwin(K, 0.9 / R, window = ('kaiser', beta)) * self.L
+        # _H[p, j] = h[p + j * L], the coefficients of phase p
+        self._H = h.reshape(taps, self.L).T.copy()
+        self._Hs = {self._H.dtype: self._H}
+        self._D = (K - 1) // 2
+
+        self._hist = np.zeros((channels, taps - 1))
+        self._n_in = 0
+        self._m_out = 0
+        self._mono = False
+
+    def process(self, x):
+        """
+        Resamples the next block of a mono signal or (channels, frames)
+        array; returns the output samples that are complete.
+        """
+        self._mono = x.ndim == 1
+        if self._mono:
+            x = x[np.newaxis]
+        L, M, T = self.L, self.M, self.taps
+        # coefficients in the input's precision, so float32 stays float32
+        H = self._Hs.get(x.dtype)
+        if H is None:
+            H = self._H.astype(x.dtype)
+            self._Hs[x.dtype] = H
+
+        last = self._n_in + x.shape[-1] - 1
+        m_end = max(((last + 1) * L - 1 - self._D) // M + 1, self._m_out)
+        buf = np.concatenate((self._hist.astype(x.dtype, copy = False), x), axis = 1)
+        base = self._n_in - (T - 1)
+
+        y = np.empty((x.shape[0], m_end - self._m_out), dtype = H.dtype)
+        j = np.arange(T)
+        for m0 in range(self._m_out, m_end, self.chunk):
+            t = np.arange(m0, min(m0 + self.chunk, m_end)) * M + self._D
+            idx = (t // L - base)[:, np.newaxis] - j
+            y[:, m0 - self._m_out:m0 - self._m_out + len(t)] = \
+                np.einsum('cmt,mt->cm', buf[:, idx], H[t % L])
+
+        self._hist = buf[:, buf.shape[1] - (T - 1):]
+        self._n_in = last + 1
+        self._m_out = m_end
+        return y[0] if self._mono else y
+
+    def flush(self):
+        """
+        Returns the remaining output at the end of the stream, so that
+        n input samples give ceil(n * fs_out / fs_in) output samples.
+        """
+        expected = -(-self._n_in * self.L // self.M)
+        pending = expected - self._m_out
+        zeros = np.zeros((self._hist.shape[0], self.taps), dtype = self._hist.dtype)
+        y = self.process(zeros[0] if self._mono else zeros)
+        return y[..., :pending]
@@ -0,0 +1,230 @@
+import asyncio
+import ipaddress
+import itertools
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from preset import readPreset, chainFromPreset, automationFromPreset
+from render import renderFile
+
+# Local render service
+# Other tools on the host submit render jobs over a Unix socket or a
+# localhost TCP port. Messages are JSON objects, one per line:
+#
+#   -> {"op": "submit", "preset": {...} or "preset.json", "input": "in.wav",
+#       "output": "out.wav", "rate": 48000, "dither": "tpdf", "precision": "float64",
+#       "linear_phase": 8191}                     (options may be left out)
+#   <- {"event": "queued", "job": 1, "queue": 3}
+#   <- {"event": "started", "job": 1}
+#   <- {"event": "progress", "job": 1, "done": 65536, "total": 441000}
+#   <- {"event": "finished", "job": 1, "seconds": 0.8, "stats": {...}}
+#      or {"event": "failed", "job": 1, "error": "..."}
+#      or {"event": "cancelled", "job": 1}
+#
+#   -> {"op": "cancel", "job": 1}
+#   -> {"op": "stats"}
+#   <- {"event": "stats", "running": 2, "queued": 3, ...}
+#
+# Events of a job go to the connection that submitted it. At most
+# max_jobs jobs render at once, on threads (sosfilt and the FFTs release
+# the GIL); up to max_queue more wait, further submissions are rejected.
+# Requests that cannot be handled get {"event": "error", "error": "..."}.
+# Clients are not authenticated and name arbitrary files to read, write
+# and (on cancel) delete, so TCP is only served on loopback addresses.
+
+class Cancelled(Exception):
+    pass
+
+class _Job:
+    def __init__(self, id, request, writer):
+        self.id = id
+        self.request = request
+        self.writer = writer
+        self.cancel = threading.Event()
+        self.task = None
+        self.started = False
+
+class RenderService:
+    """
+    Inputs:
+        max_jobs : jobs rendered concurrently, None for one per CPU
+        max_queue : jobs allowed to wait for a free slot
+        progress_interval : minimum seconds between progress events
+    """
+    def __init__(self, max_jobs = None, max_queue = 64, progress_interval = 0.2):
+        self.max_jobs = max_jobs or os.cpu_count() or 1
+        self.max_queue = max_queue
+        self.progress_interval = progress_interval
+        self._executor = ThreadPoolExecutor(max_workers = self.max_jobs)
+        self._slots = None
+        self._ids = itertools.count(1)
+        self._jobs = {}
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+
+    def stats(self):
+        return {'event': 'stats', 'running': self.running, 'queued': self.queued,
+                'max_jobs': self.max_jobs, 'max_queue': self.max_queue,
+                'completed': self.completed, 'failed': self.failed, 'cancelled': self.cancelled}
+
+    def _send(self, writer, message):
+        if not writer.is_closing():
+            writer.write(json.dumps(message).encode() + b'\n')
+
+    async def handle(self, reader, writer):
+        """
+        Serves one client connection.
+        """
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_jobs)
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                request = json.loads(line.decode())
+                op = request.get('op')
+                if op == 'submit':
+                    self._submit(request, writer)
+                elif op == 'cancel':
+                    self._cancel(request['job'], writer)
+                elif op == 'stats':
+                    self._send(writer, self.stats())
+                else:
+                    raise ValueError('unknown op: ' + str(op))
+            except Exception as e:
+                self._send(writer, {'event': 'error', 'error': '{}: {}'.format(type(e).__name__, e)})
+            await writer.drain()
+        writer.close()
+
+    def _submit(self, request, writer):
+        for key in ('preset', 'input', 'output'):
+            if key not in request:
+                raise ValueError('missing ' + key)
+        if self.queued + self.running >= self.max_jobs + self.max_queue:
+            self._send(writer, {'event': 'rejected', 'queue': self.queued,
+                                'error': 'queue full'})
+            return
+        job = _Job(next(self._ids), request, writer)
+        self._jobs[job.id] = job
+        self.queued += 1
+        self._send(writer, {'event': 'queued', 'job': job.id, 'queue': self.queued})
+        job.task = asyncio.ensure_future(self._run(job))
+
+    def _cancel(self, id, writer):
+        job = self._jobs.get(id)
+        if job is None:
+            raise ValueError('no such job: ' + str(id))
+        # a running job stops at its next block, a waiting one is dropped
+        # at once (its task may not have started, so it is done here)
+        job.cancel.set()
+        if not job.started:
+            job.task.cancel()
+            del self._jobs[job.id]
+            self.queued -= 1
+            self.cancelled += 1
+            self._send(job.writer, {'event': 'cancelled', 'job': job.id})
+
+    async def _run(self, job):
+        loop = asyncio.get_event_loop()
+        try:
+            async with self._slots:
+                self.queued -= 1
+                self.running += 1
+                job.started = True
+                try:
+                    self._send(job.writer, {'event': 'started', 'job': job.id})
+                    start = time.perf_counter()
+                    stats = await loop.run_in_executor(self._executor, self._render, job, loop)
+                    self.completed += 1
+                    self._send(job.writer, {'event': 'finished', 'job': job.id,
+                                            'seconds': time.perf_counter() - start, 'stats': stats})
+                except Cancelled:
+                    self.cancelled += 1
+                    self._send(job.writer, {'event': 'cancelled', 'job': job.id})
+                except Exception as e:
+                    self.failed += 1
+                    self._send(job.writer, {'event': 'failed', 'job': job.id,
+                                            'error': '{}: {}'.format(type(e).__name__, e)})
+                finally:
+                    self.running -= 1
+        except asyncio.CancelledError:
+            # cancelled while waiting for a slot, see _cancel
+            return
+        del self._jobs[job.id]
+
+    def _render(self, job, loop):
+        # runs on an executor thread
+        r = job.request
+        preset = r['preset']
+        coefficients = None
+        if not isinstance(preset, dict):
+            preset, coefficients = readPreset(preset)
+        chain = chainFromPreset(preset, coefficients)
+        if r.get('linear_phase'):
+            chain.setLinearPhase(r['linear_phase'])
+
+        last = 0.0
+        def progress(done, total):
+            nonlocal last
+            if job.cancel.is_set():
+                raise Cancelled()
+            now = time.perf_counter()
+            if now - last >= self.progress_interval or done == total:
+                last = now
+                loop.call_soon_threadsafe(self._send, job.writer, {'event': 'progress', 'job': job.id,
+                                                                   'done': done, 'total': total})
+
+        try:
+            return renderFile(chain, r['input'], r['output'], progress = progress, rate = r.get('rate'),
+                              dither = r.get('dither'), automation = automationFromPreset(preset),
+                              precision = r.get('precision', 'float64'))
+        except Cancelled:
+            # no half-written files are left behind
+            if os.path.exists(r['output']):
+                os.remove(r['output'])
+            raise
+
+    def close(self):
+        for job in list(self._jobs.values()):
+            job.cancel.set()
+        self._executor.shutdown(wait = True)
+
+def isLoopback(host):
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+def serve(path = None, host = '127.0.0.1', port = 8765, max_jobs = None, max_queue = 64):
+    """
+    Runs a RenderService on the Unix socket path, or on host:port if path
+    is None, until interrupted. host must be a loopback address.
+    """
+    if path is None and not isLoopback(host):
+        raise ValueError('not a loopback address: ' + str(host))
+    service = RenderService(max_jobs, max_queue)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    if path is not None:
+        server = loop.run_until_complete(asyncio.start_unix_server(service.handle, path))
+    else:
+        server = loop.run_until_complete(asyncio.start_server(service.handle, host, port))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        service.close()
+        loop.close()
+        if path is not None and os.path.exists(path):
+            os.remove(path)
@@ -1,72 +1,250 @@
-from numpy import frombuffer, dtype, empty, asarray, iinfo, log10
-from scipy.signal import lfilter, freqz
-from PySide.QtCore import QPoint
+from numpy import frombuffer, dtype, empty, asarray, array, iinfo, linspace, ones, pi, \
+    moveaxis, exp, dot, append, logspace, log10, searchsorted, sqrt, maximum, add, diff, \
+    copyto, rint, clip, count_nonzero, random
+from scipy.signal import sosfilt
 
-def byteToPCM(data, sample_width):
-    d_type = 'float'
-    if sample_width == 2:
-        d_type = 'short'
-    return frombuffer(data, dtype = d_type)
+# Sample formats of wave files, by sample width in bytes
+# 8-bit PCM is unsigned, 16/24/32-bit PCM signed, both little-endian
+_pcmTypes = {1: '<u1', 2: '<i2', 4: '<i4'}
+_floatTypes = {4: '<f4', 8: '<f8'}
+
+def byteToPCM(data, sample_width, is_float = False):
+    """
+    Decodes interleaved samples from a byte buffer. Returns a view of data,
+    except for 24-bit PCM which is unpacked into the upper three bytes of
+    int32 samples (so it scales like 32-bit PCM).
+    """
+    if is_float:
+        return frombuffer(data, dtype = _floatTypes[sample_width])
+    if sample_width in _pcmTypes:
+        return frombuffer(data, dtype = _pcmTypes[sample_width])
+    if sample_width != 3:
+        raise ValueError('unsupported sample width: ' + str(sample_width))
+
+    raw = frombuffer(data, dtype = 'u1').reshape(-1, 3)
+    sig = empty(len(raw), dtype = '<i4')
+    b = sig.view('u1').reshape(-1, 4)
+    b[:, 0] = 0
+    b[:, 1:] = raw
+    return sig
 
 def pcmToFloat(sig, type='float32'):
     sig = asarray(sig)
-    if sig.dtype.kind != 'i':
-        raise TypeError('signal must be integer')
     type = dtype(type)
     if type.kind != 'f':
         raise TypeError('type must be float')
 
+    if sig.dtype.kind == 'f':
+        return sig.astype(type, copy = False)
+    if sig.dtype.kind == 'u':
+        half = type.type(iinfo(sig.dtype).max // 2 + 1)
+        return (sig.astype(type) - half) / half
+    if sig.dtype.kind != 'i':
+        raise TypeError('signal must be integer or float')
     return sig.astype(type) / type.type(-iinfo(sig.dtype).min)
 
-def floatToPCM(sig, dtype='int16'):
-    return (sig * iinfo(dtype).max).astype(dtype)
+def floatToPCM(sig, sample_width = 2, is_float = False):
+    """
+    Encodes a float signal in [-1, 1] to the sample format given by
+    sample_width and is_float, saturating at full scale. Returns an array
+    holding the encoded bytes.
+    """
+    return Quantizer(sample_width, is_float).quantize(sig)
+
+class Quantizer:
+    """
+    Converts blocks of a float signal in [-1, 1] to a wave sample format.
+    PCM output saturates at full scale instead of wrapping around, and
+    +-1 LSB TPDF dither can be added before rounding: white ('tpdf') or
+    high-pass shaped ('hp'), the difference of successive uniform values
+    of a channel, which moves most of the dither noise above the band
+    where hearing is most sensitive.
+
+    Inputs:
+        sample_width, is_float : output format, as for byteToPCM
+        dither : None, 'tpdf' or 'hp'; ignored for float output
+        channels : channels of the interleaved input, for 'hp' dither
+        seed : optional seed of the dither noise
+
+    quantize() returns a view of an output buffer that is reused by the
+    next call, so the result must be consumed (written) before that.
+    """
+    def __init__(self, sample_width = 2, is_float = False, dither = None, channels = 1, seed = None):
+        if dither not in (None, 'tpdf', 'hp'):
+            raise ValueError('unknown dither: ' + str(dither))
+        self.sample_width = sample_width
+        self.is_float = is_float
+        self.dither = None if is_float else dither
+        self._channels = channels
+        self._rng = random.RandomState(seed)
+        self._hp = self._rng.random_sample(channels)
+
+        if is_float:
+            self._type = dtype(_floatTypes[sample_width])
+            self._scale = 1.0
+        elif sample_width == 3:
+            self._type = dtype('<i4')
+            self._scale = 8388607.
+        elif sample_width in _pcmTypes:
+            self._type = dtype(_pcmTypes[sample_width])
+            self._scale = 127. if sample_width == 1 else float(iinfo(self._type).max)
+        else:
+            raise ValueError('unsupported sample width: ' + str(sample_width))
+        self._hi = self._scale
+        self._lo = -self._scale - 1
+
+        self._work = empty(0, dtype = 'float32')
+        self._out = empty(0, dtype = self._type)
+        self._bytes = empty((0, 3), dtype = 'u1')
+        self.resetStats()
+
+    def resetStats(self):
+        self._samples = 0
+        self._clipped = 0
+        self._peak = 0.0
+
+    def stats(self):
+        """
+        Returns the number of samples converted, the number clipped (for
+        float output: beyond full scale) and the peak input level, linear
+        and in dBFS.
+        """
+        return {'samples': self._samples, 'clipped': self._clipped, 'peak': self._peak,
+                'peak_dBFS': float(20 * log10(self._peak)) if self._peak > 0 else float('-inf')}
+
+    def _buffers(self, n, work_type):
+        if len(self._work) < n or self._work.dtype != work_type:
+            self._work = empty(n, dtype = work_type)
+            self._out = empty(n, dtype = self._type)
+            if self.sample_width == 3 and not self.is_float:
+                self._bytes = empty((n, 3), dtype = 'u1')
+        return self._work[:n], self._out[:n]
+
+    def _noise(self, n):
+        if self.dither == 'tpdf':
+            return self._rng.random_sample(n) - self._rng.random_sample(n)
+        ch = self._channels
+        r = self._rng.random_sample(n + ch)
+        r[:ch] = self._hp
+        self._hp = r[n:].copy()
+        return r[ch:] - r[:n]
+
+    def quantize(self, sig):
+        sig = asarray(sig)
+        n = sig.size
+        # float32 holds up to 24-bit PCM exactly, 32-bit needs float64
+        if sig.dtype == 'float32' and (self.sample_width < 4 or self.is_float):
+            work_type = sig.dtype
+        else:
+            work_type = dtype('float64')
+        work, out = self._buffers(n, work_type)
+        if n == 0:
+            return out if self.sample_width != 3 or self.is_float else self._bytes[:0].reshape(-1)
+
+        peak = max(sig.max(), -sig.min())
+        self._samples += n
+        self._peak = max(self._peak, float(peak))
+        if self.is_float:
+            if peak > 1:
+                self._clipped += int(count_nonzero(sig > 1) + count_nonzero(sig < -1))
+            copyto(out, sig, casting = 'unsafe')
+            return out
+
+        work[...] = sig
+        work *= self._scale
+        if self.dither is not None:
+            work += self._noise(n)
+        # only blocks that can reach full scale need counting
+        if peak * self._scale + 1 > self._hi:
+            self._clipped += int(count_nonzero(work > self._hi) + count_nonzero(work < self._lo))
+            clip(work, self._lo, self._hi, out = work)
+        rint(work, out = work)
+        if self.sample_width == 1:
+            work += 128
+        copyto(out, work, casting = 'unsafe')
+        if self.sample_width != 3:
+            return out
+
+        b = self._bytes[:n]
+        b[...] = out.view('u1').reshape(-1, 4)[:, :3]
+        return b.reshape(-1)
+
+def deinterleave(sig, channels):
+    """
+    Returns a (channels, frames) view of an interleaved signal.
+    """
+    return sig.reshape(-1, channels).T
+
+def interleave(sig):
+    if sig.ndim == 1:
+        return sig
+    return sig.T.ravel()
 
 def sosfilter(sos, zi_in, x):
-    y = x
-    zi_out = zi_in
-    for i in range(len(sos)):
-        y, zi_out[i] = lfilter(sos[i,:3], sos[i,3:], y, zi = zi_in[i])
-    return y, zi_out
+    """
+    Runs x through all second-order sections of sos in a single pass,
+    filtering along the last axis of x.
+    Rows of sos must be normalized so that a0 == 1; zi_in holds one
+    (z1, z2) state pair per section with lfilter semantics, shape
+    x.shape[:-1] + (sections, 2).
+    The output is always a new array, as with sosfilt; callers may
+    change it in place.
+    """
+    # sosfilt computes in the widest type of sos, x and zi
+    zi = asarray(zi_in)
+    if len(sos) == 0:
+        return x.copy(), zi
+    y, zi = sosfilt(sos, x, zi = moveaxis(zi, -2, 0))
+    return y, moveaxis(zi, 0, -2)
+
+class FreqGrid:
+    """
+    Fixed frequency grid with a precomputed [1, exp(-jw), exp(-2jw)] basis,
+    so that responses of any number of sections are evaluated with one
+    matrix product.
+    """
+    def __init__(self, ws):
+        self.w = asarray(ws, dtype = 'float64')
+        z1 = exp(-1j * self.w)
+        self.basis = array([ones(len(z1)), z1, z1 * z1])
 
 def sosfreqz(sos, ws = None):
+    """
+    Frequency response of cascaded second-order sections evaluated at ws
+    (radians/sample, or a FreqGrid); 512 points over [0, pi) by default.
+    """
     if ws is None:
-        H = [1] * 512        
-    else:
-        H = [1] * len(ws)
-
-    for i in range(len(sos)):
-        w, h = freqz(sos[i,:3], sos[i, 3:], worN = ws)
-        H *= h
-    return w, H
-
-def toPixelCords(width, height, x, xaxis, y = 0, yaxis = None):
-    xmin = xaxis.min
-    xmax = xaxis.max       
-
-    if xaxis.log:
-        xp = log10(x / xmin + 0.000001) / log10(xmax / xmin) * width
-    else:
-        xp = (x - xmin) / (xmax - xmin) * width
-    if yaxis != None:
-        ymin = yaxis.min
-        ymax = yaxis.max
-        yp = (y - ymax) / (ymin - ymax) * height
-        return QPoint(xp, yp)
-    else:
-        return xp
-
-def fromPixelCords(width, height, point, xaxis, yaxis):
-    xmin = xaxis.min
-    xmax = xaxis.max
-    ymin = yaxis.min
-    ymax = yaxis.max
-
-    xp = point.x()
-    yp = point.y()
-
-    if xaxis.log:
-        x = 10 ** (xp * log10(xmax / xmin) / width + log10(xmin))
-    else:
-        x = xp * (xmax - xmin) / width + xmin
-    y = yp * (ymin - ymax) / height + ymax
-    return x, y
\ No newline at end of file
+        ws = linspace(0, pi, 512, endpoint = False)
+    grid = ws if isinstance(ws, FreqGrid) else FreqGrid(ws)
+
+    if len(sos) == 0:
+        return grid.w, ones(len(grid.w), dtype = 'complex')
+    H = dot(sos[:, :3], grid.basis) / dot(sos[:, 3:], grid.basis)
+    return grid.w, H.prod(axis = 0)
+
+class LogBinning:
+    """
+    Reduces the bins of a spectrum, at increasing frequencies f, to at
+    most `bands` log-spaced bands between fmin and fmax. Bands that
+    contain no bin are dropped, so at low frequencies every bin is kept.
+    """
+    def __init__(self, f, fmin, fmax, bands):
+        self.nbins = len(f)
+        self.bands = bands
+        edges = searchsorted(f, logspace(log10(fmin), log10(fmax), bands + 1))
+        starts = edges[:-1][diff(edges) > 0]
+        self._starts = starts
+        self._stop = edges[-1]
+        self._counts = diff(append(starts, self._stop))
+        # geometric centre of the bins in every band
+        self.freqs = sqrt(f[starts] * f[starts + self._counts - 1])
+
+    def reduce(self, x, mode = 'max'):
+        """
+        Aggregates x (one value per bin) per band, by maximum or mean.
+        """
+        x = x[:self._stop]
+        if mode == 'max':
+            return maximum.reduceat(x, self._starts)
+        return add.reduceat(x, self._starts) / self._counts
+
@@ -0,0 +1,190 @@
+import mmap
+import struct
+import numpy as np
+from utility import byteToPCM
+
+# Wave file I/O
+# WavReader maps the file into memory and parses the RIFF header once; the
+# data chunk is exposed as a NumPy view, so reading any frame range is a
+# slice without copies and seeking is O(1). Both classes follow the method
+# names of the standard wave module and also handle IEEE float files,
+# which the wave module rejects.
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+class WavReader:
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        try:
+            self._mm = mmap.mmap(self._file.fileno(), 0, access = mmap.ACCESS_READ)
+            self._parse()
+        except:
+            self._file.close()
+            raise
+        self._pos = 0
+
+    def _parse(self):
+        mm = self._mm
+        if len(mm) < 12 or mm[0:4] != b'RIFF' or mm[8:12] != b'WAVE':
+            raise ValueError('not a RIFF/WAVE file')
+
+        fmt = None
+        offset = 12
+        while offset + 8 <= len(mm):
+            cid = mm[offset:offset+4]
+            size = struct.unpack_from('<I', mm, offset + 4)[0]
+            body = offset + 8
+            if cid == b'fmt ':
+                fmt = struct.unpack_from('<HHIIHH', mm, body)
+                tag = fmt[0]
+                if tag == WAVE_FORMAT_EXTENSIBLE and size >= 40:
+                    # the sub-format GUID starts with the actual format tag
+                    tag = struct.unpack_from('<H', mm, body + 24)[0]
+            elif cid == b'data':
+                if fmt is None:
+                    raise ValueError('data chunk before fmt chunk')
+                # streamed files may leave the size unset or too large
+                size = min(size, len(mm) - body)
+                break
+            offset = body + size + (size & 1)
+        else:
+            raise ValueError('no data chunk')
+
+        if tag not in (WAVE_FORMAT_PCM, WAVE_FORMAT_IEEE_FLOAT):
+            raise ValueError('unsupported format tag: ' + hex(tag))
+        self._isfloat = tag == WAVE_FORMAT_IEEE_FLOAT
+        self._nchannels = fmt[1]
+        self._framerate = fmt[2]
+        self._sampwidth = (fmt[5] + 7) // 8
+        self._framesize = self._nchannels * self._sampwidth
+        self._nframes = size // self._framesize
+        self._data = np.frombuffer(mm, dtype = np.uint8, count = self._nframes * self._framesize,
+                                   offset = body)
+
+    def getnchannels(self):
+        return self._nchannels
+
+    def getsampwidth(self):
+        return self._sampwidth
+
+    def getframerate(self):
+        return self._framerate
+
+    def getnframes(self):
+        return self._nframes
+
+    def isfloat(self):
+        return self._isfloat
+
+    def frames(self, start = 0, stop = None):
+        """
+        Returns the raw bytes of frames [start, stop) as a uint8 view.
+        """
+        if stop is None:
+            stop = self._nframes
+        return self._data[start * self._framesize:stop * self._framesize]
+
+    def samples(self, start = 0, stop = None):
+        """
+        Returns frames [start, stop) decoded as (frames, channels) samples,
+        a view of the file except for 24-bit PCM.
+        """
+        data = self.frames(start, stop)
+        return byteToPCM(data, self._sampwidth, self._isfloat).reshape(-1, self._nchannels)
+
+    def readframes(self, n):
+        start = self._pos
+        self._pos = min(start + n, self._nframes)
+        return self.frames(start, self._pos)
+
+    def rewind(self):
+        self._pos = 0
+
+    def tell(self):
+        return self._pos
+
+    def setpos(self, pos):
+        if pos < 0 or pos > self._nframes:
+            raise ValueError('position not in range')
+        self._pos = pos
+
+    def close(self):
+        self._data = None
+        try:
+            self._mm.close()
+        except BufferError:
+            # views handed out are still alive; the map goes with them
+            pass
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class WavWriter:
+    """
+    Writes PCM or IEEE float wave files; the chunk sizes are filled in
+    on close.
+    """
+    def __init__(self, path, nchannels, sampwidth, framerate, is_float = False):
+        self._file = open(path, 'wb')
+        self._nchannels = nchannels
+        self._sampwidth = sampwidth
+        self._framerate = framerate
+        self._isfloat = is_float
+        self._nbytes = 0
+
+        blockalign = nchannels * sampwidth
+        if is_float:
+            # non-PCM formats carry a cbSize field and a fact chunk
+            fmt = struct.pack('<HHIIHHH', WAVE_FORMAT_IEEE_FLOAT, nchannels, framerate,
+                              framerate * blockalign, blockalign, sampwidth * 8, 0)
+            fact = b'fact' + struct.pack('<II', 4, 0)
+        else:
+            fmt = struct.pack('<HHIIHH', WAVE_FORMAT_PCM, nchannels, framerate,
+                              framerate * blockalign, blockalign, sampwidth * 8)
+            fact = b''
+        header = b'WAVE' + b'fmt ' + struct.pack('<I', len(fmt)) + fmt + fact
+        self._fact = 12 + 8 + len(fmt) + 8 if is_float else None
+        self._file.write(b'RIFF' + struct.pack('<I', 0) + header + b'data' + struct.pack('<I', 0))
+        self._header = 12 + len(header) - 4 + 8
+
+    def writeframes(self, data):
+        self._file.write(data)
+        self._nbytes += memoryview(data).nbytes
+
+    def reserve(self, nframes):
+        """
+        Extends the data by nframes frames of silence, to be filled in
+        place (e.g. by other processes); returns the file offset of the
+        first reserved frame.
+        """
+        offset = self._header + self._nbytes
+        self._nbytes += nframes * self._nchannels * self._sampwidth
+        self._file.truncate(self._header + self._nbytes)
+        self._file.seek(0, 2)
+        return offset
+
+    def close(self):
+        if self._file.closed:
+            return
+        if self._nbytes & 1:
+            self._file.write(b'\0')
+        self._file.seek(4)
+        self._file.write(struct.pack('<I', self._header - 8 + self._nbytes + (self._nbytes & 1)))
+        self._file.seek(self._header - 4)
+        self._file.write(struct.pack('<I', self._nbytes))
+        if self._fact is not None:
+            self._file.seek(self._fact)
+            self._file.write(struct.pack('<I', self._nbytes // (self._nchannels * self._sampwidth)))
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()